@@ -4,7 +4,7 @@
 
 {'name': 'Sale Exception',
  'summary': 'Custom exceptions on sale order',
- 'version': '9.0.1.0.0',
+ 'version': '9.0.1.3.0',
  'category': 'Generic Modules/Sale',
  'author': "Akretion, Sodexis, Odoo Community Association (OCA)",
  'website': 'http://www.akretion.com',
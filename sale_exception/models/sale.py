@@ -2,11 +2,114 @@
 # © 2011 Raphaël Valyi, Renato Lima, Guewen Baconnier, Sodexis
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import threading
 import time
+import tokenize
+from collections import defaultdict
+from StringIO import StringIO
 
-from openerp import api, models, fields, _
+from openerp import api, models, fields, tools, _
 from openerp.exceptions import UserError, ValidationError
-from openerp.tools.safe_eval import safe_eval
+from openerp.osv import expression
+from openerp.tools.lru import LRU
+from openerp.tools.safe_eval import safe_eval, test_expr, _SAFE_OPCODES
+
+# names under which the checked record is given to the rule code
+RULE_RECORD_NAMES = ('order', 'line', 'object', 'obj')
+# names of the evaluation context which give access to anything else than
+# the checked record, their use prevents to infer the dependencies
+RULE_OPAQUE_NAMES = ('self', 'pool', 'cr', 'uid', 'user', 'context', 'time')
+
+# last result of the rules, by database, keyed on
+# (rule id, rule write date, record id) with the values of the dependencies
+# of the rule as they were when the result was computed
+RULE_RESULTS = defaultdict(lambda: LRU(65536))
+
+# evaluation statistics stored on the rules
+STAT_FIELDS = ['stat_call_count', 'stat_record_count', 'stat_hit_count',
+               'stat_total_time', 'stat_avg_time', 'stat_max_time']
+
+
+def _sandbox_builtins():
+    """Return the restricted builtins safe_eval gives to evaluated code"""
+    space = {}
+    safe_eval('None', space, nocopy=True)
+    return space['__builtins__']
+
+
+SANDBOX_BUILTINS = _sandbox_builtins()
+
+
+def infer_rule_depends(code):
+    """Return the field paths read on the checked record by a rule code
+
+    Only plain attribute chains such as ``line.product_id.type`` can be
+    inferred. None is returned when the code calls a method on the record,
+    subscripts it, passes it around, reads attributes of local variables,
+    of subscripts or of parenthesized expressions, or uses other names of
+    the evaluation context.
+    """
+    try:
+        tokens = [(token[0], token[1]) for token in
+                  tokenize.generate_tokens(StringIO(code).readline)
+                  if token[0] not in (tokenize.COMMENT, tokenize.NL,
+                                      tokenize.NEWLINE, tokenize.INDENT,
+                                      tokenize.DEDENT)]
+    except (tokenize.TokenError, IndentationError):
+        return None
+    depends = set()
+    index = 0
+    while index < len(tokens):
+        toktype, value = tokens[index]
+        index += 1
+        if (value == '.' and index > 1 and
+                tokens[index - 2] in ((tokenize.OP, ')'),
+                                      (tokenize.OP, ']'))):
+            # attribute of an expression, e.g. (line.product_id).type
+            return None
+        if toktype != tokenize.NAME:
+            continue
+        if index > 1 and tokens[index - 2] == (tokenize.OP, '.'):
+            # attribute of something else, e.g. a field of a record
+            continue
+        if value in RULE_OPAQUE_NAMES:
+            return None
+        if value not in RULE_RECORD_NAMES:
+            if tokens[index:index + 1] == [(tokenize.OP, '.')]:
+                # attribute of a local variable, which may be a record
+                # read from the checked one
+                return None
+            continue
+        path = []
+        while (tokens[index:index + 1] == [(tokenize.OP, '.')] and
+               tokens[index + 1:index + 2] and
+               tokens[index + 1][0] == tokenize.NAME):
+            path.append(tokens[index + 1][1])
+            index += 2
+        if not path or tokens[index:index + 1] in ([(tokenize.OP, '(')],
+                                                   [(tokenize.OP, '[')]):
+            return None
+        depends.add('.'.join(path))
+    return tuple(sorted(depends))
+
+
+def add_rule_stats(stats, rule_id, records, hits, duration):
+    """Account one evaluation of a rule on records, hits of them failing
+
+    stats collects the evaluations of a run by rule id, it is saved at the
+    end of the run by SaleException._save_rule_stats. Nothing is accounted
+    when it is None.
+    """
+    if stats is None:
+        return
+    rule_stats = stats.setdefault(
+        rule_id, {'calls': 0, 'records': 0, 'hits': 0,
+                  'total_time': 0.0, 'max_time': 0.0})
+    rule_stats['calls'] += 1
+    rule_stats['records'] += records
+    rule_stats['hits'] += hits
+    rule_stats['total_time'] += duration
+    rule_stats['max_time'] = max(rule_stats['max_time'], duration)
 
 
 class SaleException(models.Model):
@@ -24,6 +127,26 @@ class SaleException(models.Model):
          ('sale.order.line', 'Sale Order Line')],
         string='Apply on', required=True)
     active = fields.Boolean('Active')
+    exception_type = fields.Selection(
+        [('by_py_code', 'By Python Code'),
+         ('by_domain', 'By Domain')],
+        string='Exception Type', required=True, default='by_py_code',
+        help="By Python Code: allows to define any arbitrary check.\n"
+             "By Domain: the check is limited to a domain on the sale "
+             "order or the sale order line, but it is evaluated in a "
+             "single query for all the checked sale orders.")
+    domain = fields.Char(
+        'Domain',
+        help="Domain of the records on which the exception applies, "
+             "e.g. [('payment_term_id', '=', False)]")
+    depends = fields.Char(
+        'Dependencies',
+        help="Comma-separated paths of the fields read by the Python code "
+             "on the checked sale order or line, e.g. "
+             "'product_id.type, product_uom_qty'. When empty, they are "
+             "inferred from the code if it only reads plain fields. A rule "
+             "with known dependencies is evaluated again on a record only "
+             "when one of these fields changed.")
     code = fields.Text(
         'Python Code',
         help="Python code executed to check if the exception apply or "
@@ -47,6 +170,183 @@ class SaleException(models.Model):
         'sale_order_exception_rel', 'exception_id', 'sale_order_id',
         string='Sale Orders',
         readonly=True)
+    stat_call_count = fields.Integer(
+        'Evaluations', readonly=True, copy=False, default=0,
+        help="Number of evaluations of the exception. A domain exception "
+             "is evaluated once for several records. The results reused "
+             "because the dependencies of the rule did not change are not "
+             "counted.")
+    stat_record_count = fields.Integer(
+        'Checked Records', readonly=True, copy=False, default=0)
+    stat_hit_count = fields.Integer(
+        'Hits', readonly=True, copy=False, default=0,
+        help="Number of checked records on which the exception applied")
+    stat_total_time = fields.Float(
+        'Total Time (ms)', readonly=True, copy=False, default=0.0,
+        digits=(16, 1))
+    stat_avg_time = fields.Float(
+        'Average Time (ms)', compute='_compute_stat_avg_time',
+        digits=(16, 3),
+        help="Average time of an evaluation")
+    stat_max_time = fields.Float(
+        'Max Time (ms)', readonly=True, copy=False, default=0.0,
+        digits=(16, 3))
+
+    @api.depends('stat_call_count', 'stat_total_time')
+    def _compute_stat_avg_time(self):
+        for rule in self:
+            if rule.stat_call_count:
+                rule.stat_avg_time = (rule.stat_total_time /
+                                      rule.stat_call_count)
+            else:
+                rule.stat_avg_time = 0.0
+
+    @api.model
+    def get_rule_stats(self):
+        """Return the evaluation statistics of the rules
+
+        The result is a dict with the ids of the evaluated rules as keys
+        and dicts with the number of evaluations (calls), checked records
+        (records), records on which the rule applied (hits), and the total
+        and max duration of an evaluation in milliseconds (total_time,
+        max_time) as values.
+        """
+        self.env.cr.execute(
+            "SELECT id, stat_call_count, stat_record_count, stat_hit_count, "
+            "stat_total_time, stat_max_time "
+            "FROM sale_exception WHERE stat_call_count > 0")
+        return dict((rule_id, {'calls': calls,
+                               'records': records,
+                               'hits': hits,
+                               'total_time': total_time,
+                               'max_time': max_time})
+                    for rule_id, calls, records, hits, total_time, max_time
+                    in self.env.cr.fetchall())
+
+    @api.model
+    def _save_rule_stats(self, stats):
+        """Add the statistics collected by add_rule_stats to the rules
+
+        All the rules are updated by a single query which increments their
+        counters, so concurrent runs do not lose each other's evaluations.
+        """
+        if not stats:
+            return
+        values = []
+        for rule_id, rule_stats in stats.iteritems():
+            values += [rule_id,
+                       rule_stats['calls'],
+                       rule_stats['records'],
+                       rule_stats['hits'],
+                       rule_stats['total_time'] * 1000,
+                       rule_stats['max_time'] * 1000]
+        self.env.cr.execute(
+            "UPDATE sale_exception AS e SET "
+            "stat_call_count = COALESCE(e.stat_call_count, 0) + s.calls, "
+            "stat_record_count = COALESCE(e.stat_record_count, 0) "
+            "+ s.records, "
+            "stat_hit_count = COALESCE(e.stat_hit_count, 0) + s.hits, "
+            "stat_total_time = COALESCE(e.stat_total_time, 0) "
+            "+ s.total_time, "
+            "stat_max_time = GREATEST(e.stat_max_time, s.max_time) "
+            "FROM (VALUES " +
+            ", ".join(["(%s, %s, %s, %s, %s::float8, %s::float8)"] *
+                      len(stats)) +
+            ") AS s (id, calls, records, hits, total_time, max_time) "
+            "WHERE e.id = s.id", values)
+        self.invalidate_cache(STAT_FIELDS, stats.keys())
+
+    @api.multi
+    def reset_rule_stats(self):
+        # not through write, which throws away the cached results
+        self.env.cr.execute(
+            "UPDATE sale_exception SET stat_call_count = 0, "
+            "stat_record_count = 0, stat_hit_count = 0, "
+            "stat_total_time = 0, stat_max_time = 0 "
+            "WHERE id IN %s", (tuple(self.ids),))
+        self.invalidate_cache(STAT_FIELDS, self.ids)
+        return True
+
+    @api.model
+    @tools.ormcache('rule_id', 'write_date')
+    def _get_compiled_code(self, rule_id, write_date):
+        """Return the safe-checked code object of a rule
+
+        The cache lives in the registry and is keyed on the write date of
+        the rule, so an edited rule is never evaluated with stale code.
+        """
+        rule = self.browse(rule_id)
+        return test_expr(rule.code, _SAFE_OPCODES, mode='exec')
+
+    @api.model
+    @tools.ormcache('rule_id', 'write_date')
+    def _get_depends(self, rule_id, write_date):
+        """Return the field paths the code of a rule depends on
+
+        None means the dependencies are unknown and the rule has to be
+        evaluated every time.
+        """
+        rule = self.browse(rule_id)
+        if rule.depends:
+            return tuple(path.strip() for path in rule.depends.split(',')
+                         if path.strip())
+        return infer_rule_depends(rule.code or '')
+
+    @api.constrains('depends', 'model')
+    def _check_depends(self):
+        for rule in self:
+            if not rule.depends:
+                continue
+            for path in rule.depends.split(','):
+                model = self.env[rule.model]
+                for name in path.strip().split('.'):
+                    field = model._fields.get(name)
+                    if field is None:
+                        raise ValidationError(
+                            _('Invalid dependency %s on %s: no field %s.') %
+                            (path.strip(), rule.model, name))
+                    if field.relational:
+                        model = self.env[field.comodel_name]
+
+    @api.multi
+    def _plan_evaluation(self):
+        """Return the rules sorted in the order they should be evaluated
+
+        The rules which are the cheapest to find an exception come first:
+        they are sorted on their average time by checked record divided by
+        their rate of hits. Rules without statistics keep their sequence
+        and come first, so they get measured.
+        """
+        all_stats = self.get_rule_stats()
+
+        def expected_cost(rule):
+            stats = all_stats.get(rule.id)
+            if not stats or not stats['records']:
+                return 0.0
+            time_by_record = stats['total_time'] / stats['records']
+            hit_rate = float(stats['hits']) / stats['records']
+            # a rule which never applied costs as much as checking all
+            # the records it has seen without finding anything
+            return time_by_record / max(hit_rate, 1.0 / stats['records'])
+        return self.sorted(key=expected_cost)
+
+    @api.multi
+    def _get_domain(self):
+        self.ensure_one()
+        return safe_eval(self.domain or '[]')
+
+    @api.multi
+    def write(self, vals):
+        self.clear_caches()
+        # write_date does not change within a transaction
+        RULE_RESULTS.pop(self.env.cr.dbname, None)
+        return super(SaleException, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        RULE_RESULTS.pop(self.env.cr.dbname, None)
+        return super(SaleException, self).unlink()
 
 
 class SaleOrder(models.Model):
@@ -74,11 +374,82 @@ class SaleOrder(models.Model):
             self.main_exception_id = False
 
     @api.model
-    def test_all_draft_orders(self):
-        order_set = self.search([('state', '=', 'draft')])
-        order_set.test_exceptions()
+    def test_all_draft_orders(self, batch_size=None, worker=0, workers=1):
+        """Test the exceptions of the draft sale orders
+
+        Without batch_size, all the draft orders are tested in the
+        transaction of the cron. Otherwise they are tested by chunks of
+        batch_size orders with a commit after each chunk. The last tested
+        id is saved in a system parameter so an interrupted run resumes
+        where it stopped.
+
+        The work can be shared between several crons: each one is given a
+        worker number from 0 to workers - 1 and only tests the orders whose
+        id modulo workers is its worker number.
+        """
+        if not batch_size:
+            order_set = self.search([('state', '=', 'draft')])
+            order_set.test_exceptions()
+            return True
+
+        param_key = 'sale_exception.test_all_draft_orders.last_id.%d.%d' % (
+            workers, worker)
+        last_id = self._get_draft_orders_progress(param_key)
+        while True:
+            self.env.cr.execute(
+                "SELECT id FROM sale_order "
+                "WHERE state = 'draft' AND id > %s AND id %% %s = %s "
+                "ORDER BY id LIMIT %s",
+                (last_id, workers, worker, batch_size))
+            order_ids = [row[0] for row in self.env.cr.fetchall()]
+            if not order_ids:
+                break
+            self.browse(order_ids).test_exceptions()
+            last_id = order_ids[-1]
+            self._set_draft_orders_progress(param_key, last_id)
+            self._commit_draft_orders_chunk()
+        # the run is complete, the next one starts from the beginning
+        self._set_draft_orders_progress(param_key, 0)
         return True
 
+    @api.model
+    def _get_draft_orders_progress(self, param_key):
+        self.env.cr.execute("SELECT value FROM ir_config_parameter "
+                            "WHERE key = %s", (param_key,))
+        row = self.env.cr.fetchone()
+        return int(row[0]) if row and row[0] else 0
+
+    @api.model
+    def _set_draft_orders_progress(self, param_key, last_id):
+        """Save the last tested id in the system parameter
+
+        The row is updated in SQL: going through set_param after each chunk
+        would clear the caches of the registry, the compiled rules included,
+        in all the workers.
+        """
+        cr = self.env.cr
+        cr.execute("UPDATE ir_config_parameter "
+                   "SET value = %s, write_uid = %s, "
+                   "write_date = now() AT TIME ZONE 'UTC' "
+                   "WHERE key = %s",
+                   (str(last_id), self._uid, param_key))
+        if not cr.rowcount:
+            cr.execute("INSERT INTO ir_config_parameter "
+                       "(key, value, create_uid, create_date, "
+                       "write_uid, write_date) "
+                       "VALUES (%s, %s, %s, now() AT TIME ZONE 'UTC', "
+                       "%s, now() AT TIME ZONE 'UTC')",
+                       (param_key, str(last_id), self._uid, self._uid))
+        self.env['ir.config_parameter'].invalidate_cache(['value'])
+
+    @api.model
+    def _commit_draft_orders_chunk(self):
+        if getattr(threading.currentThread(), 'testing', False):
+            return
+        self.env.cr.commit()  # pylint: disable=invalid-commit
+        # do not keep the records of the previous chunks in the cache
+        self.env.invalidate_all()
+
     @api.multi
     def _popup_exceptions(self):
         action = self.env.ref('sale_exception.action_sale_exception_confirm')
@@ -107,7 +478,11 @@ class SaleOrder(models.Model):
 
     @api.multi
     def action_confirm(self):
-        if self.detect_exceptions():
+        fail_fast = self.env['ir.config_parameter'].get_param(
+            'sale_exception.confirm_fail_fast')
+        orders = self.with_context(
+            sale_exception_fail_fast=tools.str2bool(fail_fast, False))
+        if orders.detect_exceptions():
             return self._popup_exceptions()
         else:
             return super(SaleOrder, self).action_confirm()
@@ -135,67 +510,260 @@ class SaleOrder(models.Model):
         as a side effect, the sale order's exception_ids column is updated with
         the list of exceptions related to the SO
         """
-        exception_obj = self.env['sale.exception']
-        order_exceptions = exception_obj.search(
-            [('model', '=', 'sale.order')])
-        line_exceptions = exception_obj.search(
-            [('model', '=', 'sale.order.line')])
+        orders = self.filtered(lambda order: not order.ignore_exception)
+        exception_ids_by_order = orders._evaluate_exceptions()
+        orders._apply_exceptions(exception_ids_by_order)
 
         all_exception_ids = []
-        for order in self:
-            if order.ignore_exception:
-                continue
-            exception_ids = order._detect_exceptions(order_exceptions,
-                                                     line_exceptions)
-            order.exception_ids = [(6, 0, exception_ids)]
-            all_exception_ids += exception_ids
+        for order in orders:
+            all_exception_ids += exception_ids_by_order[order.id]
         return all_exception_ids
 
+    @api.multi
+    def _evaluate_exceptions(self):
+        """Evaluate the exception rules on all the orders of self
+
+        Nothing is written here, the result is a dict giving the list of
+        exception ids detected for each sale order id.
+
+        With the ``sale_exception_fail_fast`` key in the context, an order
+        is not checked anymore once an exception is found, so only the
+        first exception of each order is returned.
+        """
+        fail_fast = self._context.get('sale_exception_fail_fast')
+        rules = self.env['sale.exception'].search([])._plan_evaluation()
+        self._prefetch_exception_depends(rules)
+        base_context = self._exception_rule_base_eval_context()
+        exception_ids_by_order = dict((order.id, []) for order in self)
+        stats = {}
+        if self._is_detect_exceptions_overridden():
+            # keep calling the overrides of the former per order hook
+            code_rules = rules.filtered(
+                lambda rule: rule.exception_type == 'by_py_code')
+            rules -= code_rules
+            order_rules = code_rules.filtered(
+                lambda rule: rule.model == 'sale.order')
+            line_rules = code_rules - order_rules
+            for order in self:
+                exception_ids_by_order[order.id] += order._detect_exceptions(
+                    order_rules, line_rules)
+        orders = self
+        for rule in rules:
+            if fail_fast:
+                orders = orders.filtered(
+                    lambda order: not exception_ids_by_order[order.id])
+            if not orders:
+                break
+            if rule.exception_type == 'by_domain':
+                order_ids = orders._detect_exceptions_by_domain(rule,
+                                                                stats=stats)
+            else:
+                order_ids = orders._detect_exceptions_by_code(
+                    rule, base_context, stats=stats)
+            for order_id in order_ids:
+                exception_ids_by_order[order_id].append(rule.id)
+        self.env['sale.exception']._save_rule_stats(stats)
+        return exception_ids_by_order
+
+    @api.model
+    def _is_detect_exceptions_overridden(self):
+        return (type(self)._detect_exceptions.__func__ is not
+                SaleOrder._detect_exceptions.__func__)
+
+    @api.multi
+    def _detect_exceptions(self, order_exceptions, line_exceptions):
+        """Return the ids of the Python rules failing on the order
+
+        Kept for compatibility: the rules are evaluated rule by rule for all
+        the orders by _evaluate_exceptions, which calls this method for each
+        order only when another module overrides it.
+        """
+        self.ensure_one()
+        base_context = self._exception_rule_base_eval_context()
+        exception_ids = []
+        for rule in order_exceptions:
+            if self._detect_exceptions_by_code(rule, base_context):
+                exception_ids.append(rule.id)
+        for rule in line_exceptions:
+            if self._detect_exceptions_by_code(rule, base_context):
+                exception_ids.append(rule.id)
+        return exception_ids
+
+    @api.multi
+    def _prefetch_exception_depends(self, rules):
+        """Read at once for all the orders the fields read by the rules
+
+        The Python rules then run against the cache instead of reading
+        their fields record by record.
+        """
+        lines = self.mapped('order_line')
+        for rule in rules.filtered(
+                lambda rule: rule.exception_type == 'by_py_code'):
+            depends = rule._get_depends(rule.id, rule.write_date)
+            records = self if rule.model == 'sale.order' else lines
+            for path in depends or ():
+                records.mapped(path)
+
+    @api.multi
+    def _apply_exceptions(self, exception_ids_by_order):
+        """Update the exceptions of the orders of self in bulk
+
+        Only the (order, exception) pairs which changed are deleted from or
+        inserted in the relation table, then the fields depending on the
+        exceptions are recomputed for the modified orders only.
+        """
+        if not self:
+            return
+        cr = self.env.cr
+        current = set()
+        for sub_ids in cr.split_for_in_conditions(self.ids):
+            cr.execute("SELECT sale_order_id, exception_id "
+                       "FROM sale_order_exception_rel "
+                       "WHERE sale_order_id IN %s", (sub_ids,))
+            current.update(cr.fetchall())
+        wanted = set((order_id, exception_id)
+                     for order_id, exception_ids
+                     in exception_ids_by_order.iteritems()
+                     for exception_id in exception_ids)
+
+        to_delete = current - wanted
+        to_insert = wanted - current
+        for pairs in cr.split_for_in_conditions(list(to_delete)):
+            cr.execute("DELETE FROM sale_order_exception_rel "
+                       "WHERE (sale_order_id, exception_id) IN %s",
+                       (pairs,))
+        for pairs in cr.split_for_in_conditions(list(to_insert)):
+            cr.execute("INSERT INTO sale_order_exception_rel "
+                       "(sale_order_id, exception_id) VALUES " +
+                       ", ".join(["%s"] * len(pairs)),
+                       pairs)
+
+        changed = self.browse(
+            list(set(order_id for order_id, __ in to_delete | to_insert)))
+        if not changed:
+            return
+        changed.invalidate_cache(['exception_ids'])
+        self.env['sale.exception'].invalidate_cache(['sale_order_ids'])
+        # recompute every stored field depending on the exceptions
+        changed.modified(['exception_ids'])
+        self.recompute()
+
     @api.model
-    def _exception_rule_eval_context(self, obj_name, rec):
-        user = self.env['res.users'].browse(self._uid)
-        return {obj_name: rec,
-                'self': self.pool.get(rec._name),
-                'object': rec,
-                'obj': rec,
-                'pool': self.pool,
+    def _exception_rule_base_eval_context(self):
+        """Return the part of the evaluation context shared by all the rules
+
+        It is built once for all the records checked together.
+        """
+        return {'pool': self.pool,
                 'cr': self._cr,
                 'uid': self._uid,
-                'user': user,
-                'time': time,
-                # copy context to prevent side-effects of eval
-                'context': self._context.copy()}
+                'user': self.env.user,
+                'time': time}
 
     @api.model
-    def _rule_eval(self, rule, obj_name, rec):
-        expr = rule.code
-        space = self._exception_rule_eval_context(obj_name, rec)
+    def _exception_rule_eval_context(self, obj_name, rec, base_context=None):
+        if base_context is None:
+            base_context = self._exception_rule_base_eval_context()
+        space = dict(base_context)
+        space.update({obj_name: rec,
+                      'self': self.pool.get(rec._name),
+                      'object': rec,
+                      'obj': rec,
+                      # copy context to prevent side-effects of eval
+                      'context': dict(self._context)})
+        return space
+
+    @api.model
+    def _rule_eval(self, rule, obj_name, rec, base_context=None,
+                   stats=None):
+        return self._rule_eval_cached(rule, obj_name, rec, base_context,
+                                      stats=stats)
+
+    @api.model
+    def _rule_eval_cached(self, rule, obj_name, rec, base_context=None,
+                          stats=None):
+        """Return whether the rule fails on the record
+
+        When the dependencies of the rule are known, the result of its last
+        evaluation on the record is reused as long as the values of these
+        dependencies did not change.
+        """
+        depends = rule._get_depends(rule.id, rule.write_date)
+        if depends is None:
+            return self._rule_eval_code(rule, obj_name, rec, base_context,
+                                        stats=stats)
+        values = []
+        for path in depends:
+            value = rec.mapped(path)
+            if isinstance(value, models.BaseModel):
+                value = value.ids
+            values.append(value)
+        results = RULE_RESULTS[self.env.cr.dbname]
+        key = (rule.id, rule.write_date, rec.id)
+        cached = results.get(key)
+        if cached is not None and cached[0] == values:
+            return cached[1]
+        failed = self._rule_eval_code(rule, obj_name, rec, base_context,
+                                      stats=stats)
+        results[key] = (values, failed)
+        return failed
+
+    @api.model
+    def _rule_eval_code(self, rule, obj_name, rec, base_context=None,
+                        stats=None):
+        start = time.time()
+        space = self._exception_rule_eval_context(obj_name, rec,
+                                                  base_context)
+        # a rule must not change the builtins of the next ones
+        space['__builtins__'] = dict(SANDBOX_BUILTINS)
         try:
-            safe_eval(expr,
-                      space,
-                      mode='exec',
-                      nocopy=True)  # nocopy allows to return 'result'
+            code = rule._get_compiled_code(rule.id, rule.write_date)
+            eval(code, space)  # pylint: disable=eval-used
         except Exception, e:
             raise UserError(
                 _('Error when evaluating the sale exception '
                   'rule:\n %s \n(%s)') % (rule.name, e))
-        return space.get('failed', False)
+        failed = space.get('failed', False)
+        add_rule_stats(stats, rule.id, 1, int(bool(failed)),
+                       time.time() - start)
+        return failed
 
     @api.multi
-    def _detect_exceptions(self, order_exceptions,
-                           line_exceptions):
-        self.ensure_one()
-        exception_ids = []
-        for rule in order_exceptions:
-            if self._rule_eval(rule, 'order', self):
-                exception_ids.append(rule.id)
+    def _detect_exceptions_by_domain(self, rule, stats=None):
+        """Return the ids of the orders of self matched by a domain rule"""
+        if not self:
+            return set()
+        start = time.time()
+        domain = rule._get_domain()
+        if rule.model == 'sale.order':
+            domain = expression.AND([domain, [('id', 'in', self.ids)]])
+            order_ids = set(self.search(domain).ids)
+        else:
+            domain = expression.AND([domain, [('order_id', 'in', self.ids)]])
+            lines = self.env['sale.order.line'].search(domain)
+            order_ids = set(lines.mapped('order_id').ids)
+        add_rule_stats(stats, rule.id, len(self),
+                       len(order_ids), time.time() - start)
+        return order_ids
 
-        for order_line in self.order_line:
-            for rule in line_exceptions:
-                if rule.id in exception_ids:
-                    # we do not matter if the exception as already been
-                    # found for an order line of this order
-                    continue
-                if self._rule_eval(rule, 'line', order_line):
-                    exception_ids.append(rule.id)
-        return exception_ids
+    @api.multi
+    def _detect_exceptions_by_code(self, rule, base_context=None,
+                                   stats=None):
+        """Return the ids of the orders of self matched by a Python rule"""
+        if base_context is None:
+            base_context = self._exception_rule_base_eval_context()
+        order_ids = set()
+        for order in self:
+            if rule.model == 'sale.order':
+                failed = self._rule_eval(rule, 'order', order, base_context,
+                                         stats=stats)
+            else:
+                # we do not matter if the exception has already been
+                # found for an order line of this order
+                failed = any(
+                    self._rule_eval(rule, 'line', line, base_context,
+                                    stats=stats)
+                    for line in order.order_line)
+            if failed:
+                order_ids.add(order.id)
+        return order_ids
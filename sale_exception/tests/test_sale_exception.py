@@ -1,26 +1,32 @@
 from openerp.exceptions import ValidationError
 from openerp.addons.sale.tests.test_sale_order import TestSaleOrder
+from openerp.addons.sale_exception.models.sale import infer_rule_depends
 
 
 class TestSaleException(TestSaleOrder):
 
+    def _create_order(self, partner, **overrides):
+        vals = {
+            'partner_id': partner.id,
+            'partner_invoice_id': partner.id,
+            'partner_shipping_id': partner.id,
+            'pricelist_id': self.env.ref('product.list0').id,
+        }
+        vals.update(overrides)
+        return self.env['sale.order'].create(vals)
+
     def test_sale_order_exception(self):
         exception = self.env.ref('sale_exception.excep_no_zip')
         exception.active = True
         partner = self.env.ref('base.res_partner_1')
         partner.zip = False
         p = self.env.ref('product.product_product_6')
-        so = self.env['sale.order'].create({
-            'partner_id': partner.id,
-            'partner_invoice_id': partner.id,
-            'partner_shipping_id': partner.id,
-            'order_line': [(0, 0, {'name': p.name,
-                                   'product_id': p.id,
-                                   'product_uom_qty': 2,
-                                   'product_uom': p.uom_id.id,
-                                   'price_unit': p.list_price})],
-            'pricelist_id': self.env.ref('product.list0').id,
-        })
+        so = self._create_order(
+            partner, order_line=[(0, 0, {'name': p.name,
+                                         'product_id': p.id,
+                                         'product_uom_qty': 2,
+                                         'product_uom': p.uom_id.id,
+                                         'price_unit': p.list_price})])
 
         # confirm quotation
         so.action_confirm()
@@ -60,3 +66,179 @@ class TestSaleException(TestSaleOrder):
                                    'price_unit': p.list_price})]
         })
         exception.active = False
+
+    def test_sale_order_exception_code_change(self):
+        exception = self.env.ref('sale_exception.excep_no_zip')
+        exception.active = True
+        partner = self.env.ref('base.res_partner_1')
+        partner.zip = False
+        so = self._create_order(partner)
+        self.assertEqual(so.detect_exceptions(), [exception.id])
+
+        # the compiled code of the rule must follow its edition
+        exception.code = 'failed = False'
+        self.assertEqual(so.detect_exceptions(), [])
+        self.assertFalse(so.exception_ids)
+        exception.active = False
+
+    def test_sale_order_exception_by_domain(self):
+        exception = self.env['sale.exception'].create({
+            'name': 'No ZIP code on destination (domain)',
+            'model': 'sale.order.line',
+            'exception_type': 'by_domain',
+            'domain': "[('order_id.partner_shipping_id.zip', '=', False)]",
+            'active': True,
+        })
+        partner = self.env.ref('base.res_partner_1')
+        partner.zip = False
+        p = self.env.ref('product.product_product_6')
+        so = self._create_order(
+            partner, order_line=[(0, 0, {'name': p.name,
+                                         'product_id': p.id,
+                                         'product_uom_qty': 2,
+                                         'product_uom': p.uom_id.id,
+                                         'price_unit': p.list_price})])
+        self.assertEqual(so.detect_exceptions(), [exception.id])
+        self.assertEqual(so.main_exception_id, exception)
+
+        partner.zip = '1000'
+        self.assertEqual(so.detect_exceptions(), [])
+        self.assertFalse(so.main_exception_id)
+
+    def test_sale_order_exception_batch(self):
+        exception = self.env.ref('sale_exception.excep_no_zip')
+        exception.active = True
+        partner_nozip = self.env.ref('base.res_partner_1')
+        partner_nozip.zip = False
+        partner_zip = self.env.ref('base.res_partner_2')
+        partner_zip.zip = '1000'
+        orders = self.env['sale.order']
+        for partner in (partner_nozip, partner_zip, partner_nozip):
+            orders |= self._create_order(partner)
+        self.assertEqual(orders.detect_exceptions(),
+                         [exception.id, exception.id])
+        self.assertEqual(orders.mapped('main_exception_id'), exception)
+        self.assertFalse(orders[1].exception_ids)
+
+        # only the orders whose exceptions changed are updated
+        partner_nozip.zip = '1000'
+        self.assertEqual(orders.detect_exceptions(), [])
+        self.assertFalse(orders.mapped('exception_ids'))
+        self.assertFalse(orders.mapped('main_exception_id'))
+        exception.active = False
+
+    def test_all_draft_orders_by_chunks(self):
+        exception = self.env.ref('sale_exception.excep_no_zip')
+        exception.active = True
+        partner = self.env.ref('base.res_partner_1')
+        partner.zip = False
+        orders = self.env['sale.order']
+        for __ in range(3):
+            orders |= self._create_order(partner)
+        # 2 workers, each one testing its half of the orders
+        self.env['sale.order'].test_all_draft_orders(1, 0, 2)
+        self.env['sale.order'].test_all_draft_orders(1, 1, 2)
+        for order in orders:
+            self.assertEqual(order.exception_ids, exception)
+        # a complete run resets the progress of the worker
+        self.assertEqual(
+            self.env['ir.config_parameter'].get_param(
+                'sale_exception.test_all_draft_orders.last_id.2.0'), '0')
+        exception.active = False
+
+    def test_rule_depends(self):
+        exception = self.env.ref('sale_exception.excep_no_zip')
+        self.assertEqual(infer_rule_depends(exception.code),
+                         ('partner_shipping_id.zip',))
+        self.assertEqual(
+            infer_rule_depends("failed = line.price_unit < line.discount"),
+            ('discount', 'price_unit'))
+        # calls and aliases can read anything
+        self.assertIsNone(
+            infer_rule_depends("failed = not line.is_available()"))
+        self.assertIsNone(infer_rule_depends(
+            "failed = any(l.price_unit for l in order.order_line)"))
+        self.assertIsNone(infer_rule_depends("failed = bool(context)"))
+        # subscripts and parenthesized expressions hide the fields read
+        self.assertIsNone(infer_rule_depends(
+            "failed = order.order_line[0].price_unit < 0"))
+        self.assertIsNone(infer_rule_depends(
+            "failed = (line.product_id).type == 'service'"))
+
+        with self.assertRaises(ValidationError):
+            exception.depends = 'partner_shipping_id.no_such_field'
+        exception.depends = 'partner_shipping_id.zip, partner_id'
+        self.assertEqual(
+            exception._get_depends(exception.id, exception.write_date),
+            ('partner_shipping_id.zip', 'partner_id'))
+
+    def test_rule_stats(self):
+        exception = self.env.ref('sale_exception.excep_no_zip')
+        exception.active = True
+        exception.reset_rule_stats()
+        partner = self.env.ref('base.res_partner_1')
+        partner.zip = False
+        so = self._create_order(partner)
+        so.detect_exceptions()
+        partner.zip = '1000'
+        so.detect_exceptions()
+        # the dependencies did not change, the cached result is not counted
+        so.detect_exceptions()
+        stats = self.env['sale.exception'].get_rule_stats()[exception.id]
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['records'], 2)
+        self.assertEqual(stats['hits'], 1)
+        self.assertTrue(stats['max_time'] <= stats['total_time'])
+        self.assertEqual(exception.stat_call_count, 2)
+        self.assertEqual(exception.stat_hit_count, 1)
+        exception.reset_rule_stats()
+        self.assertEqual(exception.stat_call_count, 0)
+        self.assertNotIn(exception.id,
+                         self.env['sale.exception'].get_rule_stats())
+        exception.active = False
+
+    def test_sale_order_exception_fail_fast(self):
+        exception = self.env.ref('sale_exception.excep_no_zip')
+        exception.active = True
+        exception_2 = self.env['sale.exception'].create({
+            'name': 'No payment term',
+            'model': 'sale.order',
+            'exception_type': 'by_domain',
+            'domain': "[('payment_term_id', '=', False)]",
+            'active': True,
+        })
+        partner = self.env.ref('base.res_partner_1')
+        partner.zip = False
+        so = self._create_order(partner, payment_term_id=False)
+        self.assertEqual(set(so.detect_exceptions()),
+                         set([exception.id, exception_2.id]))
+        exception_ids = so.with_context(
+            sale_exception_fail_fast=True).detect_exceptions()
+        self.assertEqual(len(exception_ids), 1)
+        self.assertEqual(len(so.exception_ids), 1)
+        exception.active = False
+
+    def test_detect_exceptions_compatibility(self):
+        exception = self.env.ref('sale_exception.excep_no_zip')
+        exception.active = True
+        partner = self.env.ref('base.res_partner_1')
+        partner.zip = False
+        so = self._create_order(partner)
+        self.assertEqual(
+            so._detect_exceptions(exception, self.env['sale.exception']),
+            [exception.id])
+        self.assertFalse(so._is_detect_exceptions_overridden())
+
+    def test_rule_modifying_context(self):
+        exception = self.env['sale.exception'].create({
+            'name': 'Context',
+            'model': 'sale.order',
+            'active': True,
+            'code': "context['checked'] = True\nfailed = False",
+        })
+        partner = self.env.ref('base.res_partner_1')
+        so = self._create_order(partner)
+        so.detect_exceptions()
+        self.assertNotIn(exception, so.exception_ids)
+        self.assertNotIn('checked', so._context)
+        exception.active = False
@@ -19,7 +19,7 @@
 #
 #
 {'name': 'Sale stock exception',
- 'version': '8.0.1.2.0',
+ 'version': '8.0.1.3.0',
  'author': "Camptocamp,Odoo Community Association (OCA)",
  'maintainer': 'Camptocamp',
  'category': 'sale',
@@ -53,11 +53,30 @@ both for odoo and OCB).
 **Warning:**
 
 The second test is a workaround to compensate the lack of
-stock reservation process in OpenERP. This can be a performance killer
-and should not be be used if you have hundreds of simultaneous open SO.
+stock reservation process in OpenERP. The virtual stock is projected in time
+from the open moves of the location in one query per location, but it should
+still not be used if you have hundreds of simultaneous open SO.
+
+**Available to promise:**
+
+When the system parameter ``sale_exception_nostock.atp_enabled`` is set to
+``True``, the quantities of the open moves are kept by product, location,
+owner and day in the ``stock.atp`` table, updated each time a move is
+created, written or deleted, and both tests read it instead of the moves.
+The table is filled again when the parameter gets enabled, and when the
+module is updated. The moves of a day are then accounted at the end of that
+day.
+
+**Index:**
+
+The open moves are indexed by product, source and destination locations
+at the installation. When ``stock_move`` has more than a million rows, the
+index is not created to avoid locking the moves while it is built: the log
+then gives the ``CREATE INDEX CONCURRENTLY`` statement to run by hand.
 """,
  'website': 'http://www.camptocamp.com',
- 'data': ["data/data.xml"],
+ 'data': ["security/ir.model.access.csv",
+          "data/data.xml"],
  'demo': [],
  'test': ['test/no_stock_test.yml'],
  'installable': False,
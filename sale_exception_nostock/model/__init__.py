@@ -19,3 +19,6 @@
 #
 #
 from . import sale
+from . import stock_atp
+from . import stock_location
+from . import stock_move
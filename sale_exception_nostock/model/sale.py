@@ -19,8 +19,13 @@
 #
 #
 import datetime
+from collections import defaultdict
+
 from openerp import models, fields, api
 from openerp.tools.translate import _
+import openerp.addons.decimal_precision as dp
+
+from .stock_projection import StockProjection
 
 
 class SaleOrderLine(models.Model):
@@ -45,34 +50,101 @@ class SaleOrderLine(models.Model):
         # delay is a float, that is perfectly supported by timedelta
         return date_order + datetime.timedelta(days=self.delay)
 
-    def _find_parent_locations(self):
+    def _find_parent_locations(self, ancestor_ids=None):
+        """Return the ids of the customer location and of its parents
+
+        :param ancestor_ids: optional result of
+                             stock.location._get_ancestor_ids_batch for the
+                             customer locations of a batch of lines
+        """
         location = self.order_id.partner_shipping_id.property_stock_customer
+        if not location:
+            return [False]
+        if ancestor_ids is not None and location.id in ancestor_ids:
+            return list(ancestor_ids[location.id])
+        return list(self.env['stock.location']._get_ancestor_ids(location.id))
 
-        res = [location.id]
-        while location.location_id:
-            location = location.location_id
-            res.append(location.id)
-        return res
+    @api.model
+    def _get_predicted_rule_depends(self):
+        depends = ['product_id',
+                   'product_id.route_ids',
+                   'product_id.categ_id.total_route_ids',
+                   'route_id',
+                   'order_id.warehouse_id',
+                   'order_id.partner_shipping_id.property_stock_customer']
+        if 'warehouse_id' in self._fields:
+            # the warehouse of the line, added by sale_sourced_by_line
+            depends.append('warehouse_id')
+        return depends
+
+    predicted_rule_id = fields.Many2one(
+        'procurement.rule',
+        string='Predicted Procurement Rule',
+        compute='_compute_predicted_rule',
+        help="Rule expected to be chosen for the procurement of the line "
+             "when the order is confirmed.")
 
     @api.multi
-    def _predict_rules(self):
-        """Choose a rule without a procurement.
-
-        This imitates what will be done when the order is validated, with the
-        difference that here we do not have a procurement yet.
+    @api.depends(lambda self: self._get_predicted_rule_depends())
+    def _compute_predicted_rule(self):
+        """Predict the rules of a batch of lines
 
+        The prediction is kept in the cache of the line for the transaction,
+        and lines with the same prediction parameters share the same rule
+        searches.
         """
-        Rule = self.env['procurement.rule']
-        Warehouse = self.env['stock.warehouse']
+        # read the customer locations of all the shipping partners and their
+        # parents at once
+        locations = self.mapped(
+            'order_id.partner_shipping_id.property_stock_customer')
+        ancestor_ids = self.env['stock.location']._get_ancestor_ids_batch(
+            locations.ids)
+        rules_by_key = {}
+        for line in self:
+            if not (line.product_id and line.order_id):
+                line.predicted_rule_id = False
+                continue
+            key = line._get_rule_prediction_key(ancestor_ids)
+            if key not in rules_by_key:
+                rules_by_key[key] = self._search_predicted_rules(*key)[:1]
+            line.predicted_rule_id = rules_by_key[key]
 
+    @api.multi
+    def _get_rule_prediction_key(self, ancestor_ids=None):
+        """Return the parameters the predicted rule depends on
+
+        They are the warehouse id, the ids of the parent locations of the
+        destination, the ids of the routes of the line and the ids of the
+        routes of the product. ancestor_ids is passed on to
+        _find_parent_locations.
+
+        """
+        self.ensure_one()
         order = self.order_id
         procurement_data = order._prepare_order_line_procurement(order, self)
         # normally this is the order's warehouse, but modules like
         # sale_sourced_by_line change this behaviour
+        product_routes = (self.product_id.route_ids |
+                          self.product_id.categ_id.total_route_ids)
+        return (procurement_data['warehouse_id'],
+                tuple(self._find_parent_locations(ancestor_ids)),
+                tuple(self.route_id.ids),
+                tuple(sorted(product_routes.ids)))
+
+    @api.model
+    def _search_predicted_rules(self, warehouse_id, location_ids,
+                                procurement_route_ids, product_route_ids):
+        """Search the rules matching the prediction parameters
+
+        The routes are tried in the same order as when a procurement looks
+        for its rule: the routes of the procurement, of the product, of the
+        warehouse, and finally the rules without route.
 
-        warehouse = Warehouse.browse(procurement_data['warehouse_id'])
+        """
+        Rule = self.env['procurement.rule']
+        warehouse = self.env['stock.warehouse'].browse(warehouse_id)
 
-        domain = [('location_id', 'in', self._find_parent_locations())]
+        domain = [('location_id', 'in', list(location_ids))]
         warehouse_route_ids = []
         if warehouse:
             domain += [
@@ -82,40 +154,40 @@ class SaleOrderLine(models.Model):
             ]
             warehouse_route_ids = [x.id for x in warehouse.route_ids]
 
-        product_route_ids = [
-            x.id
-            for x in self.product_id.route_ids +
-            self.product_id.categ_id.total_route_ids]
-        procurement_route_ids = [x.id for x in self.route_id]
         res = Rule.search(
-            domain + [('route_id', 'in', procurement_route_ids)],
+            domain + [('route_id', 'in', list(procurement_route_ids))],
             order='route_sequence, sequence'
         )
-
         if not res:
             res = Rule.search(
-                domain + [('route_id', 'in', product_route_ids)],
+                domain + [('route_id', 'in', list(product_route_ids))],
+                order='route_sequence, sequence'
+            )
+        if not res and warehouse_route_ids:
+            res = Rule.search(
+                domain + [('route_id', 'in', warehouse_route_ids)],
                 order='route_sequence, sequence'
             )
-            if not res:
-                res = warehouse_route_ids and Rule.search(
-                    domain + [('route_id', 'in', warehouse_route_ids)],
-                    order='route_sequence, sequence'
-                ) or []
-                if not res:
-                    res = Rule.search(domain + [('route_id', '=', False)],
-                                      order='sequence')
+        if not res:
+            res = Rule.search(domain + [('route_id', '=', False)],
+                              order='sequence')
         return res
 
     @api.multi
-    def _get_line_location(self):
-        """ Get the source location from the predicted rule"""
+    def _predict_rules(self):
+        """Choose a rule without a procurement.
+
+        This imitates what will be done when the order is validated, with the
+        difference that here we do not have a procurement yet.
 
-        rules = self._predict_rules()
+        """
+        return self._search_predicted_rules(*self._get_rule_prediction_key())
 
-        if rules:
-            return rules[0].location_src_id
-        return False
+    @api.multi
+    def _get_line_location(self):
+        """ Get the source location from the predicted rule"""
+        self.ensure_one()
+        return self.predicted_rule_id.location_src_id or False
 
     @api.multi
     def _is_make_to_stock(self):
@@ -125,23 +197,120 @@ class SaleOrderLine(models.Model):
     @api.multi
     def _predict_procure_method(self):
         """Predict the procurement method that will be chosen"""
-        rules = self._predict_rules()
-        return rules[0].procure_method
+        self.ensure_one()
+        return self.predicted_rule_id.procure_method
 
     @api.multi
     def _should_skip_stock_checks(self):
         self.ensure_one()
 
-        if (
-            self.product_id and
-            self.product_id.type == 'product' and
-            self._is_make_to_stock() and
-            self._get_line_location() and
-            self._get_line_location().usage == 'internal'
-        ):
-            return False
-        else:
+        if not (self.product_id and self.product_id.type == 'product'):
             return True
+        if not self._is_make_to_stock():
+            return True
+        location = self._get_line_location()
+        return not (location and location.usage == 'internal')
+
+    virtual_available_at_delivery = fields.Float(
+        string='Virtual Stock at Delivery Date',
+        compute='_compute_virtual_available_at_delivery',
+        digits=dp.get_precision('Product Unit of Measure'),
+        help="Virtual quantity of the product in the predicted source "
+             "location at the delivery date of the line.")
+
+    @api.multi
+    @api.depends('product_id', 'delay', 'order_id.date_order',
+                 'predicted_rule_id')
+    def _compute_virtual_available_at_delivery(self):
+        """Compute the virtual stock at delivery date of a batch of lines
+
+        The quantities of all the lines are computed together by
+        ``_get_virtual_available_batch``.
+        """
+        keys = {}
+        for line in self:
+            if line._should_skip_stock_checks():
+                continue
+            delivery_date = line._compute_line_delivery_date()[0]
+            keys[line.id] = (line.product_id.id,
+                             line._get_line_location().id,
+                             fields.Datetime.to_string(delivery_date),
+                             line._get_stock_owner_id())
+        quantities = self._get_virtual_available_batch(keys.values())
+        for line in self:
+            line.virtual_available_at_delivery = quantities.get(
+                keys.get(line.id), 0.0)
+
+    @api.multi
+    def _get_stock_owner_id(self):
+        """Return the id of the stock owner of the line, if any"""
+        self.ensure_one()
+        try:
+            return self.stock_owner_id.id
+        except AttributeError:
+            # module sale_owner_stock_sourcing not installed, fine
+            return False
+
+    @api.model
+    def _get_virtual_available_batch(self, keys):
+        """Compute the virtual quantities of many products at once
+
+        The products are grouped by location, date and owner, and the
+        quantities of each group are computed in one pass. Virtual qty is
+        made on all childs of the locations.
+
+        :param keys: iterable of (product_id, location_id, to_date,
+                     owner_id) tuples, owner_id can be False
+        :return: dict with the keys as keys and the virtual quantities
+                 as values
+
+        """
+        if self.env['stock.atp']._is_enabled():
+            return self._get_virtual_available_atp(keys)
+
+        product_ids_by_group = defaultdict(set)
+        for product_id, location_id, to_date, owner_id in keys:
+            product_ids_by_group[(location_id, to_date, owner_id)].add(
+                product_id)
+
+        res = {}
+        for group, product_ids in product_ids_by_group.iteritems():
+            location_id, to_date, owner_id = group
+            ctx = {
+                'to_date': to_date,
+                'compute_child': True,
+                'location': location_id,
+            }
+            if owner_id:
+                ctx['owner_id'] = owner_id
+            products = self.env['product.product'].with_context(ctx).browse(
+                list(product_ids))
+            for data in products.read(['virtual_available']):
+                key = (data['id'], location_id, to_date, owner_id)
+                res[key] = data['virtual_available']
+        return res
+
+    @api.model
+    def _get_virtual_available_atp(self, keys):
+        """Variant of ``_get_virtual_available_batch`` using the
+        available-to-promise table, with one projection by location and
+        owner for all the dates."""
+        keys = list(keys)
+        product_ids_by_group = defaultdict(set)
+        for product_id, location_id, to_date, owner_id in keys:
+            product_ids_by_group[(location_id, owner_id)].add(product_id)
+        projections = {}
+        for (location_id, owner_id), product_ids in \
+                product_ids_by_group.iteritems():
+            projections[(location_id, owner_id)] = \
+                self._get_stock_projections(product_ids, location_id,
+                                            owner_id)
+        res = {}
+        for key in keys:
+            product_id, location_id, to_date, owner_id = key
+            projection = projections[(location_id, owner_id)][product_id]
+            res[key] = projection.qty_at(to_date)
+        return res
 
     @api.multi
     def can_command_at_delivery_date(self):
@@ -158,29 +327,9 @@ class SaleOrderLine(models.Model):
         self.ensure_one()
         if self._should_skip_stock_checks():
             return True
-        delivery_date = self._compute_line_delivery_date()[0]
-        delivery_date = fields.Datetime.to_string(delivery_date)
-        location = self._get_line_location()
-
-        assert location, _("No rules specifies a location"
-                           " for this sale order line")
-        ctx = {
-            'to_date': delivery_date,
-            'compute_child': True,
-            'location': location.id,
-            }
-
-        try:
-            ctx['owner_id'] = self.stock_owner_id.id
-        except AttributeError:
-            # module sale_owner_stock_sourcing not installed, fine
-            pass
-
-        # Virtual qty is made on all childs of chosen location
-        prod_for_virtual_qty = (self.product_id
-                                .with_context(ctx)
-                                .virtual_available)
-        if prod_for_virtual_qty < self.product_uom_qty:
+        assert self._get_line_location(), _("No rules specifies a location"
+                                            " for this sale order line")
+        if self.virtual_available_at_delivery < self.product_uom_qty:
             return False
         return True
 
@@ -188,72 +337,143 @@ class SaleOrderLine(models.Model):
     def _get_states(self):
         return ('waiting', 'confirmed', 'assigned')
 
+    affects_future_orders = fields.Boolean(
+        string='Affects Future Orders',
+        compute='_compute_affects_future_orders',
+        help="The virtual stock of the source location would become too "
+             "low to deliver the moves already planned after the delivery "
+             "date of the line.")
+
+    @api.multi
+    @api.depends('product_id', 'product_uom_qty', 'delay',
+                 'order_id.date_order', 'predicted_rule_id')
+    def _compute_affects_future_orders(self):
+        """Check the future orders of a batch of lines
+
+        One stock projection is built for all the lines sharing a product,
+        a source location and an owner.
+        """
+        lines_by_group = defaultdict(list)
+        for line in self:
+            line.affects_future_orders = False
+            if line._should_skip_stock_checks():
+                continue
+            group = (line._get_line_location().id, line._get_stock_owner_id())
+            lines_by_group[group].append(line)
+
+        for (location_id, owner_id), lines in lines_by_group.iteritems():
+            product_ids = set(line.product_id.id for line in lines)
+            projections = self._get_stock_projections(product_ids,
+                                                      location_id, owner_id)
+            for line in lines:
+                delivery_date = line._compute_line_delivery_date()[0]
+                delivery_date = fields.Datetime.to_string(delivery_date)
+                projection = projections[line.product_id.id]
+                min_qty = projection.min_qty_after(delivery_date)
+                line.affects_future_orders = (
+                    min_qty is not None and min_qty < line.product_uom_qty)
+
     @api.model
-    def _get_affected_dates(self, location_id, product_id, delivery_date):
-        """Determine future dates where virtual stock has to be checked.
+    def _get_stock_projections(self, product_ids, location_id, owner_id):
+        """Build the stock projections of products in a location
+
+        The open moves of all the products entering or leaving the location
+        or its children are read in one query, from the available-to-promise
+        table when it is enabled. The moves leaving the location itself in
+        one of the states of ``_get_states`` are the checks of the
+        projection.
 
-        It will only look for stock move that pass by location_id.
-        If your stock location have children or you have configured automated
-        stock action
-        they must pass by the location related to SO line, else the will be
-        ignored
+        :return: dict of StockProjection by product id
 
-        :param location_id: location id to be checked
-        :param product_id: product id te be checked
+        """
+        location = self.env['stock.location'].browse(location_id)
+        ctx = {'location': location_id, 'compute_child': True}
+        if owner_id:
+            ctx['owner_id'] = owner_id
+        products = self.env['product.product'].with_context(ctx).browse(
+            list(product_ids))
+        qty_on_hand = dict((data['id'], data['qty_available'])
+                           for data in products.read(['qty_available']))
+
+        if self.env['stock.atp']._is_enabled():
+            moves = self.env['stock.atp']._get_projection_moves(
+                product_ids, location, owner_id)
+        else:
+            moves = self._get_projection_moves(product_ids, location,
+                                               owner_id)
+        moves_by_product = defaultdict(list)
+        for product_id, date, qty, is_check in moves:
+            moves_by_product[product_id].append((date, qty, is_check))
 
-        :return: list of dates to be checked
+        return dict((product_id,
+                     StockProjection(qty_on_hand[product_id],
+                                     moves_by_product[product_id]))
+                    for product_id in product_ids)
+
+    @api.model
+    def _get_projection_moves(self, product_ids, location, owner_id):
+        """Read the open moves entering or leaving a location tree
+
+        :return: list of (product_id, date, quantity, is_check) tuples
 
         """
-        cr = self._cr
-        sql = ("SELECT date FROM stock_move"
-               "  WHERE state IN %s"
-               "   AND date > %s"
-               "   AND product_id = %s"
-               "   AND location_id = %s")
-        cr.execute(sql, (self._get_states(),
-                         delivery_date,
-                         product_id,
-                         location_id))
-        return (row[0] for row in cr.fetchall())
+        params = {
+            'left': location.parent_left,
+            'right': location.parent_right,
+            'location_id': location.id,
+            'states': self._get_states(),
+            'product_ids': tuple(product_ids),
+            'owner_id': owner_id,
+        }
+        sql = ("SELECT m.product_id, m.date,"
+               "  m.product_qty * ("
+               "   (dest.parent_left >= %(left)s"
+               "    AND dest.parent_left < %(right)s)::int -"
+               "   (src.parent_left >= %(left)s"
+               "    AND src.parent_left < %(right)s)::int),"
+               "  m.location_id = %(location_id)s"
+               " FROM stock_move m"
+               " JOIN stock_location src ON src.id = m.location_id"
+               " JOIN stock_location dest ON dest.id = m.location_dest_id"
+               " WHERE m.product_id IN %(product_ids)s"
+               "  AND m.state IN %(states)s"
+               "  AND ((src.parent_left >= %(left)s"
+               "        AND src.parent_left < %(right)s)"
+               "       OR (dest.parent_left >= %(left)s"
+               "           AND dest.parent_left < %(right)s))")
+        if owner_id:
+            sql += "  AND m.restrict_partner_id = %(owner_id)s"
+        self._cr.execute(sql, params)
+        return self._cr.fetchall()
 
     @api.multi
     def future_orders_are_affected(self):
         """Predicate function that is a naive workaround for the lack of stock
         reservation.
 
-        This can be a performance killer, you should not use it
-        if you have constantly a lot of running Orders
+        The virtual stock is projected in time from the open moves of the
+        source location, and checked at the date of each move leaving it
+        after the delivery date of the line.
 
         :return: True if future order are affected by current command line
         """
         self.ensure_one()
         if self._should_skip_stock_checks():
             return False
-        delivery_date = self._compute_line_delivery_date()[0]
-        delivery_date = fields.Datetime.to_string(delivery_date)
-        location = self._get_line_location()
-        assert location, _("No rules specifies a location"
-                           " for this sale order line")
+        assert self._get_line_location(), _("No rules specifies a location"
+                                            " for this sale order line")
+        return self.affects_future_orders
 
-        ctx = {
-            'compute_child': True,
-            'location_id': location.id,
-            }
 
-        try:
-            ctx['owner_id'] = self.stock_owner_id.id
-        except AttributeError:
-            # module sale_owner_stock_sourcing not installed, fine
-            pass
-
-        # Virtual qty is made on all childs of chosen location
-        dates = self._get_affected_dates(location.id, self.product_id.id,
-                                         delivery_date)
-        for aff_date in dates:
-            ctx['to_date'] = aff_date
-            prod_for_virtual_qty = (self.product_id
-                                    .with_context(ctx)
-                                    .virtual_available)
-            if prod_for_virtual_qty < self.product_uom_qty:
-                return True
-        return False
+class SaleOrder(models.Model):
+    _inherit = "sale.order"
+
+    @api.multi
+    def detect_exceptions(self):
+        # the stock may have changed since the last check of these orders,
+        # the quantities of all their lines are then computed together
+        lines = self.mapped('order_line')
+        lines.invalidate_cache(['predicted_rule_id',
+                                'virtual_available_at_delivery',
+                                'affects_future_orders'], lines.ids)
+        return super(SaleOrder, self).detect_exceptions()
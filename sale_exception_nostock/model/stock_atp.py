@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+#
+#    Copyright 2016 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+from collections import defaultdict
+
+import psycopg2
+
+from openerp import models, fields, api, tools
+from openerp.tools import float_is_zero
+import openerp.addons.decimal_precision as dp
+
+OPEN_MOVE_STATES = ('waiting', 'confirmed', 'assigned')
+ATP_ENABLED_PARAM = 'sale_exception_nostock.atp_enabled'
+# one row by product, location, owner and day, the owner being optional
+ATP_UNIQUE_INDEX = 'stock_atp_product_location_owner_date_uniq'
+
+
+class StockAtp(models.Model):
+
+    """Available to promise quantities by product, location, owner and day.
+
+    The table holds the quantities of the open moves entering and leaving
+    each location, and is maintained incrementally when moves are created,
+    written or deleted. It is only used and maintained when the system
+    parameter ``sale_exception_nostock.atp_enabled`` is set, and it is
+    filled again when the parameter gets enabled.
+
+    """
+
+    _name = 'stock.atp'
+    _description = 'Available to Promise'
+    _log_access = False
+
+    product_id = fields.Many2one('product.product', string='Product',
+                                 required=True, index=True,
+                                 ondelete='cascade')
+    location_id = fields.Many2one('stock.location', string='Location',
+                                  required=True, index=True,
+                                  ondelete='cascade')
+    owner_id = fields.Many2one('res.partner', string='Owner',
+                               ondelete='cascade')
+    date = fields.Date(required=True)
+    qty_in = fields.Float(
+        string='Incoming Quantity',
+        digits=dp.get_precision('Product Unit of Measure'))
+    qty_out = fields.Float(
+        string='Outgoing Quantity',
+        digits=dp.get_precision('Product Unit of Measure'))
+    check_count = fields.Integer(
+        string='Outgoing Moves',
+        help="Number of open moves leaving the location on this day")
+
+    def init(self, cr):
+        cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                   (ATP_UNIQUE_INDEX,))
+        if not cr.fetchone():
+            # the table is only valid once rebuilt, it is emptied so that
+            # rows duplicated before the index existed do not prevent it
+            cr.execute("DELETE FROM stock_atp")
+            cr.execute("CREATE UNIQUE INDEX " + ATP_UNIQUE_INDEX +
+                       " ON stock_atp"
+                       " (product_id, location_id, COALESCE(owner_id, 0),"
+                       "  date)")
+        cr.execute("SELECT value FROM ir_config_parameter WHERE key = %s",
+                   (ATP_ENABLED_PARAM,))
+        row = cr.fetchone()
+        if row and tools.str2bool(row[0], default=False):
+            self._rebuild_table(cr)
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _is_enabled(self):
+        """Return whether the table is maintained and used
+
+        The parameter is kept in the cache of the registry, cleared when it
+        is modified, as it is read by every write on the moves.
+
+        """
+        enabled = self.env['ir.config_parameter'].get_param(
+            ATP_ENABLED_PARAM)
+        return tools.str2bool(enabled, default=False)
+
+    @api.model
+    def _update_enabled(self, was_enabled):
+        """Take a change of the parameter into account
+
+        The table is not maintained while it is disabled, so it is filled
+        again when it gets enabled.
+
+        """
+        self.clear_caches()
+        if self._is_enabled() and not was_enabled:
+            self._rebuild_table(self._cr)
+            self.invalidate_cache()
+
+    def _rebuild_table(self, cr):
+        """Compute again the whole table from the open moves"""
+        cr.execute("DELETE FROM stock_atp")
+        cr.execute(
+            "INSERT INTO stock_atp"
+            " (product_id, location_id, owner_id, date,"
+            "  qty_in, qty_out, check_count)"
+            " SELECT product_id, location_id, owner_id, date,"
+            "  SUM(qty_in), SUM(qty_out), SUM(check_count)"
+            " FROM ("
+            "  SELECT product_id, location_dest_id AS location_id,"
+            "   restrict_partner_id AS owner_id, date::date AS date,"
+            "   product_qty AS qty_in, 0.0 AS qty_out, 0 AS check_count"
+            "  FROM stock_move WHERE state IN %(states)s"
+            "  UNION ALL"
+            "  SELECT product_id, location_id, restrict_partner_id,"
+            "   date::date, 0.0, product_qty, 1"
+            "  FROM stock_move WHERE state IN %(states)s"
+            " ) AS moves"
+            " GROUP BY product_id, location_id, owner_id, date",
+            {'states': OPEN_MOVE_STATES})
+
+    @api.model
+    def _get_move_fields(self):
+        """Fields of the moves changing their available to promise"""
+        return ('state', 'date', 'product_id', 'product_uom_qty',
+                'product_uom', 'location_id', 'location_dest_id',
+                'restrict_partner_id')
+
+    @api.model
+    def _add_moves(self, move_ids, sign):
+        """Add (sign=1) or remove (sign=-1) moves from the table"""
+        if not move_ids:
+            return
+        cr = self._cr
+        cr.execute("SELECT product_id, location_id, location_dest_id,"
+                   " restrict_partner_id, date::date, product_qty"
+                   " FROM stock_move"
+                   " WHERE id IN %s AND state IN %s",
+                   (tuple(move_ids), OPEN_MOVE_STATES))
+        changes = defaultdict(lambda: [0.0, 0.0, 0])
+        for (product_id, location_id, location_dest_id, owner_id, date,
+             qty) in cr.fetchall():
+            incoming = changes[(product_id, location_dest_id, owner_id, date)]
+            incoming[0] += sign * qty
+            outgoing = changes[(product_id, location_id, owner_id, date)]
+            outgoing[1] += sign * qty
+            outgoing[2] += sign
+
+        for key, (qty_in, qty_out, check_count) in changes.iteritems():
+            if not self._update_row(key, qty_in, qty_out, check_count):
+                try:
+                    # a concurrent transaction may insert the same row
+                    with cr.savepoint():
+                        cr.execute("INSERT INTO stock_atp"
+                                   " (product_id, location_id, owner_id,"
+                                   "  date, qty_in, qty_out, check_count)"
+                                   " VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                                   key + (qty_in, qty_out, check_count))
+                except psycopg2.IntegrityError:
+                    self._update_row(key, qty_in, qty_out, check_count)
+        self.invalidate_cache(['qty_in', 'qty_out', 'check_count'])
+
+    @api.model
+    def _update_row(self, key, qty_in, qty_out, check_count):
+        """Add quantities to a row of the table, deleted once empty
+
+        :param key: (product_id, location_id, owner_id, date) of the row
+        :return: whether the row exists
+
+        """
+        cr = self._cr
+        product_id, location_id, owner_id, date = key
+        cr.execute("UPDATE stock_atp"
+                   " SET qty_in = qty_in + %s, qty_out = qty_out + %s,"
+                   "  check_count = check_count + %s"
+                   " WHERE product_id = %s AND location_id = %s"
+                   "  AND COALESCE(owner_id, 0) = %s AND date = %s"
+                   " RETURNING id, qty_in, qty_out, check_count",
+                   (qty_in, qty_out, check_count,
+                    product_id, location_id, owner_id or 0, date))
+        row = cr.fetchone()
+        if not row:
+            return False
+        row_id, row_qty_in, row_qty_out, row_check_count = row
+        precision = self.env['decimal.precision'].precision_get(
+            'Product Unit of Measure')
+        if (not row_check_count and
+                float_is_zero(row_qty_in, precision_digits=precision) and
+                float_is_zero(row_qty_out, precision_digits=precision)):
+            # no open move is left on the row
+            cr.execute("DELETE FROM stock_atp WHERE id = %s", (row_id,))
+        return True
+
+    @api.model
+    def _get_projection_moves(self, product_ids, location, owner_id):
+        """Read the quantities entering or leaving a location tree by day
+
+        Same result as the method of sale.order.line, with the quantities
+        of the moves of a day grouped at the end of that day.
+
+        :return: list of (product_id, date, quantity, is_check) tuples
+
+        """
+        params = {
+            'left': location.parent_left,
+            'right': location.parent_right,
+            'location_id': location.id,
+            'product_ids': tuple(product_ids),
+            'owner_id': owner_id,
+        }
+        sql = ("SELECT a.product_id,"
+               "  to_char(a.date, 'YYYY-MM-DD 23:59:59'),"
+               "  SUM(a.qty_in - a.qty_out),"
+               "  SUM(CASE WHEN a.location_id = %(location_id)s"
+               "      THEN a.check_count ELSE 0 END) > 0"
+               " FROM stock_atp a"
+               " JOIN stock_location l ON l.id = a.location_id"
+               " WHERE a.product_id IN %(product_ids)s"
+               "  AND l.parent_left >= %(left)s"
+               "  AND l.parent_left < %(right)s")
+        if owner_id:
+            sql += "  AND a.owner_id = %(owner_id)s"
+        sql += (" GROUP BY a.product_id, a.date"
+                # moves between locations of the tree cancel each other
+                " HAVING SUM(a.qty_in - a.qty_out) <> 0"
+                "  OR SUM(CASE WHEN a.location_id = %(location_id)s"
+                "      THEN a.check_count ELSE 0 END) > 0")
+        self._cr.execute(sql, params)
+        return self._cr.fetchall()
+
+
+class IrConfigParameter(models.Model):
+    _inherit = 'ir.config_parameter'
+
+    @api.model
+    def create(self, vals):
+        atp_obj = self.env['stock.atp']
+        was_enabled = atp_obj._is_enabled()
+        res = super(IrConfigParameter, self).create(vals)
+        if vals.get('key') == ATP_ENABLED_PARAM:
+            atp_obj._update_enabled(was_enabled)
+        return res
+
+    @api.multi
+    def write(self, vals):
+        atp_obj = self.env['stock.atp']
+        was_enabled = atp_obj._is_enabled()
+        keys = self.mapped('key') + [vals.get('key')]
+        res = super(IrConfigParameter, self).write(vals)
+        if ATP_ENABLED_PARAM in keys:
+            atp_obj._update_enabled(was_enabled)
+        return res
+
+    @api.multi
+    def unlink(self):
+        if ATP_ENABLED_PARAM in self.mapped('key'):
+            self.env['stock.atp'].clear_caches()
+        return super(IrConfigParameter, self).unlink()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+#
+#    Copyright 2016 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+from openerp import models, api, tools
+
+
+class StockLocation(models.Model):
+    _inherit = 'stock.location'
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_ancestor_ids(self, location_id):
+        """Return the ids of a location and of all its parents
+
+        The ids are ordered from the location up to the root. They are kept
+        in the cache of the registry until a location is moved.
+
+        """
+        return self._get_ancestor_ids_batch([location_id])[location_id]
+
+    @api.model
+    def _get_ancestor_ids_batch(self, location_ids):
+        """Return the ancestors of many locations in one query
+
+        The parent store gives the ancestors of all the locations at once,
+        without walking up the parents one browse at a time.
+
+        :return: dict of tuples of ids by location id, each tuple ordered
+                 from the location up to the root
+
+        """
+        res = dict((location_id, ()) for location_id in location_ids)
+        if not res:
+            return res
+        self._cr.execute("SELECT l.id, a.id FROM stock_location l"
+                         " JOIN stock_location a"
+                         "  ON a.parent_left <= l.parent_left"
+                         "  AND a.parent_right > l.parent_left"
+                         " WHERE l.id IN %s"
+                         " ORDER BY l.id, a.parent_left DESC",
+                         (tuple(res),))
+        for location_id, ancestor_id in self._cr.fetchall():
+            res[location_id] += (ancestor_id,)
+        return res
+
+    @api.multi
+    def write(self, vals):
+        if 'location_id' in vals:
+            self.clear_caches()
+        return super(StockLocation, self).write(vals)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+#
+#    Copyright 2016 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+import logging
+
+from openerp import models, api
+
+_logger = logging.getLogger(__name__)
+
+# above this estimated number of moves, the index is not created at install
+# because building it would lock the moves for too long
+OPEN_MOVE_INDEX_MAX_ROWS = 1000000
+OPEN_MOVE_INDEX = 'stock_move_sale_exception_nostock_open_product_idx'
+# former index on the source location and date, unused by the projections
+OLD_OPEN_MOVE_INDEX = 'stock_move_sale_exception_nostock_open_idx'
+
+
+class StockMove(models.Model):
+    _inherit = 'stock.move'
+
+    def init(self, cr):
+        """Index the open moves by product and locations
+
+        It serves the projections of the virtual stock, which read the open
+        moves of the products entering or leaving a location tree. On large
+        tables, the index has to be created concurrently by hand so that
+        the moves are not locked while it is built.
+
+        """
+        cr.execute("DROP INDEX IF EXISTS " + OLD_OPEN_MOVE_INDEX)
+        cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                   (OPEN_MOVE_INDEX,))
+        if cr.fetchone():
+            return
+        definition = ("%s ON stock_move"
+                      " (product_id, location_id, location_dest_id)"
+                      " WHERE state IN ('waiting', 'confirmed', 'assigned')"
+                      % OPEN_MOVE_INDEX)
+        cr.execute("SELECT reltuples FROM pg_class"
+                   " WHERE relname = 'stock_move'")
+        if cr.fetchone()[0] > OPEN_MOVE_INDEX_MAX_ROWS:
+            _logger.warning("stock_move is too large to be indexed during "
+                            "the installation, please create the index "
+                            "with: CREATE INDEX CONCURRENTLY %s", definition)
+            return
+        cr.execute("CREATE INDEX " + definition)
+
+    @api.model
+    def create(self, vals):
+        move = super(StockMove, self).create(vals)
+        atp_obj = self.env['stock.atp']
+        if atp_obj._is_enabled():
+            atp_obj._add_moves(move.ids, 1)
+        return move
+
+    @api.multi
+    def write(self, vals):
+        atp_obj = self.env['stock.atp']
+        update_atp = (set(vals) & set(atp_obj._get_move_fields()) and
+                      atp_obj._is_enabled())
+        if update_atp:
+            atp_obj._add_moves(self.ids, -1)
+        res = super(StockMove, self).write(vals)
+        if update_atp:
+            atp_obj._add_moves(self.ids, 1)
+        return res
+
+    @api.multi
+    def unlink(self):
+        atp_obj = self.env['stock.atp']
+        if atp_obj._is_enabled():
+            atp_obj._add_moves(self.ids, -1)
+        return super(StockMove, self).unlink()
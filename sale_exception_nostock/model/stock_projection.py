@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+#
+#    Copyright 2016 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+import bisect
+from operator import itemgetter
+
+
+class StockProjection(object):
+
+    """Projection in time of the virtual stock of a product in a location.
+
+    The projection is built from the quantity on hand and the open moves
+    entering or leaving the location. Some of the moves are marked as
+    checks: the virtual stock must stay high enough at their dates, e.g.
+    because they deliver orders already placed.
+
+    The minimum of the virtual stock over the checks after a given date is
+    answered with a binary search on the suffix minima of the projection.
+
+    """
+
+    def __init__(self, qty_on_hand, moves):
+        """
+        :param qty_on_hand: current quantity in the location
+        :param moves: iterable of (date, quantity, is_check) tuples, the
+                      quantity being positive for incoming moves and
+                      negative for outgoing ones
+
+        """
+        self.qty_on_hand = qty_on_hand
+        self.dates = []
+        self.qties = []
+        self.check_dates = []
+        self.min_qties = []
+        events = sorted(moves, key=itemgetter(0))
+        qty = qty_on_hand
+        index = 0
+        while index < len(events):
+            # the virtual stock at a date includes all the moves of that date
+            date = events[index][0]
+            is_check = False
+            while index < len(events) and events[index][0] == date:
+                qty += events[index][1]
+                is_check = is_check or events[index][2]
+                index += 1
+            self.dates.append(date)
+            self.qties.append(qty)
+            if is_check:
+                self.check_dates.append(date)
+                self.min_qties.append(qty)
+        for index in xrange(len(self.min_qties) - 2, -1, -1):
+            self.min_qties[index] = min(self.min_qties[index],
+                                        self.min_qties[index + 1])
+
+    def qty_at(self, date):
+        """Return the virtual stock at date, including the moves of date"""
+        index = bisect.bisect_right(self.dates, date)
+        if not index:
+            return self.qty_on_hand
+        return self.qties[index - 1]
+
+    def min_qty_after(self, date):
+        """Return the lowest virtual stock at the checks strictly after date
+
+        :return: the quantity, or None when there is no check after date
+
+        """
+        index = bisect.bisect_right(self.check_dates, date)
+        if index == len(self.check_dates):
+            return None
+        return self.min_qties[index]
@@ -1 +1,2 @@
 from . import test_dropshipping_skip_check
+from . import test_stock_projection
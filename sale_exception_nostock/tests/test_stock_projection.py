@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+#
+#    Copyright 2016 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+import random
+
+from openerp.tests import common
+
+from ..model.stock_projection import StockProjection
+
+
+def scan_min_qty_after(qty_on_hand, moves, date):
+    """Compute StockProjection.min_qty_after by scanning all the moves"""
+    res = None
+    for check_date, __, is_check in moves:
+        if not is_check or check_date <= date:
+            continue
+        qty = qty_on_hand + sum(qty for move_date, qty, __ in moves
+                                if move_date <= check_date)
+        if res is None or qty < res:
+            res = qty
+    return res
+
+
+class TestStockProjection(common.BaseCase):
+
+    def assertMatchesScan(self, qty_on_hand, moves, dates):
+        projection = StockProjection(qty_on_hand, moves)
+        for date in dates:
+            self.assertEqual(projection.min_qty_after(date),
+                             scan_min_qty_after(qty_on_hand, moves, date),
+                             'min_qty_after(%r) of %r' % (date, moves))
+
+    def test_same_day_moves(self):
+        moves = [('2016-03-01', -5.0, True),
+                 ('2016-03-01', 3.0, False),
+                 ('2016-03-02', -1.0, True)]
+        projection = StockProjection(4.0, moves)
+        # the check sees all the moves of its date, incoming ones included
+        self.assertEqual(projection.qty_at('2016-03-01'), 2.0)
+        self.assertEqual(projection.min_qty_after('2016-02-28'), 1.0)
+        # the checks of the date itself are excluded
+        self.assertEqual(projection.min_qty_after('2016-03-01'), 1.0)
+        self.assertMatchesScan(4.0, moves, ['2016-02-28', '2016-03-01',
+                                            '2016-03-02'])
+
+    def test_date_before_first_move(self):
+        moves = [('2016-03-05', -2.0, True),
+                 ('2016-03-10', 5.0, False),
+                 ('2016-03-12', -4.0, True)]
+        projection = StockProjection(1.0, moves)
+        self.assertEqual(projection.qty_at('2016-03-01'), 1.0)
+        self.assertEqual(projection.min_qty_after('2016-03-01'), -1.0)
+        self.assertMatchesScan(1.0, moves, ['2016-03-01'])
+
+    def test_date_after_last_move(self):
+        moves = [('2016-03-05', -2.0, True),
+                 ('2016-03-10', 5.0, False)]
+        projection = StockProjection(1.0, moves)
+        self.assertEqual(projection.qty_at('2016-04-01'), 4.0)
+        self.assertIsNone(projection.min_qty_after('2016-04-01'))
+        # no check after the last one
+        self.assertIsNone(projection.min_qty_after('2016-03-05'))
+        self.assertMatchesScan(1.0, moves, ['2016-03-05', '2016-04-01'])
+
+    def test_moves_without_check(self):
+        moves = [('2016-03-05', -2.0, False),
+                 ('2016-03-10', 5.0, False)]
+        projection = StockProjection(1.0, moves)
+        self.assertEqual(projection.qty_at('2016-03-06'), -1.0)
+        self.assertIsNone(projection.min_qty_after('2016-03-01'))
+        # moves which are not checks still count in the checked quantities
+        moves.append(('2016-03-07', -1.0, True))
+        projection = StockProjection(1.0, moves)
+        self.assertEqual(projection.min_qty_after('2016-03-01'), -2.0)
+        self.assertMatchesScan(1.0, moves, ['2016-03-01', '2016-03-06',
+                                            '2016-03-07'])
+
+    def test_random_moves(self):
+        rnd = random.Random(42)
+        dates = ['2016-03-%02d' % day for day in xrange(1, 16)]
+        for __ in xrange(50):
+            moves = [(rnd.choice(dates[1:-1]),
+                      float(rnd.randint(-5, 5)),
+                      rnd.random() < 0.5)
+                     for __ in xrange(rnd.randint(0, 12))]
+            self.assertMatchesScan(float(rnd.randint(0, 10)), moves, dates)
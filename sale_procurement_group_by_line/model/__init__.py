@@ -1 +1,4 @@
 from . import sale
+from . import procurement
+from . import stock
+from . import ir_config_parameter
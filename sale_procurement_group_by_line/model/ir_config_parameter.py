@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+#
+#    Copyright 2016 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+from openerp import models, api
+
+from .sale import STORE_PICKING_IDS_PARAM
+
+
+class IrConfigParameter(models.Model):
+    _inherit = 'ir.config_parameter'
+
+    @api.model
+    def create(self, vals):
+        if vals.get('key') == STORE_PICKING_IDS_PARAM:
+            self.env['sale.order'].clear_caches()
+        return super(IrConfigParameter, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if STORE_PICKING_IDS_PARAM in self.mapped('key') + [vals.get('key')]:
+            self.env['sale.order'].clear_caches()
+        return super(IrConfigParameter, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        if STORE_PICKING_IDS_PARAM in self.mapped('key'):
+            self.env['sale.order'].clear_caches()
+        return super(IrConfigParameter, self).unlink()
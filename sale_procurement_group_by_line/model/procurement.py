@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+#
+#    Copyright 2016 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+from collections import defaultdict
+
+from openerp import models, api, fields
+
+CLOSED_STATES = ('cancel', 'done')
+
+
+class ProcurementGroup(models.Model):
+    _inherit = 'procurement.group'
+
+    procurement_count = fields.Integer(
+        string='Procurements',
+        readonly=True,
+        help="Number of procurements of the group, maintained when "
+             "procurements are created, moved or deleted.")
+    open_procurement_count = fields.Integer(
+        string='Open Procurements',
+        readonly=True,
+        help="Number of procurements of the group neither done nor "
+             "cancelled, maintained at each transition of a procurement.")
+
+    def init(self, cr):
+        cr.execute("UPDATE procurement_group"
+                   " SET procurement_count = 0, open_procurement_count = 0")
+        cr.execute("UPDATE procurement_group g"
+                   " SET procurement_count = counts.total,"
+                   "  open_procurement_count = counts.open"
+                   " FROM (SELECT group_id,"
+                   "        COUNT(*) AS total,"
+                   "        SUM(CASE WHEN state IN %s THEN 0 ELSE 1 END)"
+                   "        AS open"
+                   "       FROM procurement_order"
+                   "       WHERE group_id IS NOT NULL"
+                   "       GROUP BY group_id) AS counts"
+                   " WHERE counts.group_id = g.id",
+                   (CLOSED_STATES,))
+
+    @api.multi
+    def _get_procurement_counts(self):
+        """Return the number of procurements and of open procurements
+
+        The counters are used for the records in database, records not saved
+        yet count their procurements.
+
+        """
+        self.ensure_one()
+        if isinstance(self.id, models.NewId):
+            procurements = self.procurement_ids
+            open_procurements = procurements.filtered(
+                lambda proc: proc.state not in CLOSED_STATES)
+            return len(procurements), len(open_procurements)
+        return self.procurement_count, self.open_procurement_count
+
+    @api.model
+    def _add_procurement_counts(self, counts, sign):
+        """Add (sign=1) or remove (sign=-1) counts of procurements
+
+        The counters are incremented in SQL so that concurrent transactions
+        do not lose each other's changes.
+
+        :param counts: dict of (total, open) counts by group id
+        """
+        group_ids = []
+        for group_id, (total, open_count) in counts.iteritems():
+            if not (total or open_count):
+                continue
+            self.env.cr.execute(
+                "UPDATE procurement_group"
+                " SET procurement_count ="
+                "  COALESCE(procurement_count, 0) + %s,"
+                "  open_procurement_count ="
+                "  COALESCE(open_procurement_count, 0) + %s"
+                " WHERE id = %s",
+                (sign * total, sign * open_count, group_id))
+            group_ids.append(group_id)
+        if not group_ids:
+            return
+        fnames = ['procurement_count', 'open_procurement_count']
+        self.invalidate_cache(fnames, group_ids)
+        # recompute the stored fields depending on the counters
+        self.browse(group_ids).modified(fnames)
+        self.recompute()
+
+
+class ProcurementOrder(models.Model):
+    _inherit = 'procurement.order'
+
+    @api.multi
+    def _get_group_counts(self):
+        """Return the (total, open) counts of the procurements by group"""
+        counts = defaultdict(lambda: [0, 0])
+        for proc in self:
+            if proc.group_id:
+                counts[proc.group_id.id][0] += 1
+                if proc.state not in CLOSED_STATES:
+                    counts[proc.group_id.id][1] += 1
+        return counts
+
+    @api.model
+    def create(self, vals):
+        proc = super(ProcurementOrder, self).create(vals)
+        self.env['procurement.group']._add_procurement_counts(
+            proc._get_group_counts(), 1)
+        return proc
+
+    @api.multi
+    def write(self, vals):
+        if not ('state' in vals or 'group_id' in vals):
+            return super(ProcurementOrder, self).write(vals)
+        before = self._get_group_counts()
+        res = super(ProcurementOrder, self).write(vals)
+        after = self._get_group_counts()
+        # only apply the difference, in most writes a single group changes
+        # of a single open procurement
+        changes = {}
+        for group_id in set(before) | set(after):
+            old = before.get(group_id, (0, 0))
+            new = after.get(group_id, (0, 0))
+            changes[group_id] = (new[0] - old[0], new[1] - old[1])
+        self.env['procurement.group']._add_procurement_counts(changes, 1)
+        return res
+
+    @api.multi
+    def unlink(self):
+        counts = self._get_group_counts()
+        res = super(ProcurementOrder, self).unlink()
+        self.env['procurement.group']._add_procurement_counts(counts, -1)
+        return res
@@ -18,9 +18,13 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 #
-from openerp import models, api, fields, osv
+from collections import OrderedDict
+
+from openerp import models, api, fields, osv, tools
 from openerp.osv import orm
 
+STORE_PICKING_IDS_PARAM = 'sale_procurement_group_by_line.store_picking_ids'
+
 
 class SaleOrder(models.Model):
     _inherit = 'sale.order'
@@ -30,6 +34,33 @@ class SaleOrder(models.Model):
         """ Hook to be able to use line data on procurement group """
         return self._prepare_procurement_group(line.order_id)
 
+    @api.model
+    def _create_procurement_groups_by_line(self, order):
+        """Create the procurement groups of the lines of an order
+
+        The key of each line is computed once, one group is created by key
+        and all the lines of a group are written at once.
+
+        :return: dict of procurement group ids by sale order line id
+        """
+        line_ids_by_key = OrderedDict()
+        lines_by_id = {}
+        for line in order.order_line:
+            key = line._get_procurement_group_key()
+            line_ids_by_key.setdefault(key, []).append(line.id)
+            lines_by_id[line.id] = line
+
+        group_ids = {}
+        for line_ids in line_ids_by_key.itervalues():
+            vals = self._prepare_procurement_group_by_line(
+                lines_by_id[line_ids[0]])
+            group = self.env['procurement.group'].create(vals)
+            self.env['sale.order.line'].browse(line_ids).write(
+                {'procurement_group_id': group.id})
+            for line_id in line_ids:
+                group_ids[line_id] = group.id
+        return group_ids
+
     ###
     # OVERRIDE to create procurement group by sale order line grouped by
     # a key defined by `_get_procurement_group_key`
@@ -46,26 +77,22 @@ class SaleOrder(models.Model):
         for order in self.browse(cr, uid, ids, context=context):
             proc_ids = []
 
-            groups = {}
+            group_ids = self._create_procurement_groups_by_line(
+                cr, uid, order, context=context)
+
+            # Try to fix exception procurement (possible when after a
+            # shipping exception the user choose to recreate)
+            # first check them to see if they are in exception or not
+            # (one of the related moves is cancelled)
+            check_ids = [proc.id for line in order.order_line
+                         for proc in line.procurement_ids
+                         if proc.state not in ['cancel', 'done']]
+            if check_ids:
+                procurement_obj.check(cr, uid, check_ids)
+                order.refresh()
 
             for line in order.order_line:
-                group_id = groups.get(line._get_procurement_group_key())
-                if not group_id:
-                    vals = self._prepare_procurement_group_by_line(
-                        cr, uid, line, context=context)
-                    group_id = self.pool["procurement.group"].create(
-                        cr, uid, vals, context=context)
-                    groups[line._get_procurement_group_key()] = group_id
-                line.write({'procurement_group_id': group_id})
-                # Try to fix exception procurement (possible when after a
-                # shipping exception the user choose to recreate)
                 if line.procurement_ids:
-                    # first check them to see if they are in exception or not
-                    # (one of the related moves is cancelled)
-                    procurement_obj.check(
-                        cr, uid, [x.id for x in line.procurement_ids
-                                  if x.state not in ['cancel', 'done']])
-                    line.refresh()
                     # run again procurement that are in exception in order to
                     # trigger another move
                     proc_ids += [x.id for x in line.procurement_ids
@@ -76,14 +103,17 @@ class SaleOrder(models.Model):
                         continue
                     vals = self._prepare_order_line_procurement(
                         cr, uid, order, line,
-                        group_id=group_id, context=context)
+                        group_id=group_ids[line.id], context=context)
                     proc_id = procurement_obj.create(
                         cr, uid, vals, context=context)
                     proc_ids.append(proc_id)
             # Confirm procurement order such that rules will be applied on it
             # note that the workflow normally ensure proc_ids isn't an empty
             # list
-            procurement_obj.run(cr, uid, proc_ids, context=context)
+            # When the order is confirmed in a batch, the procurements of all
+            # the orders are run together by `action_confirm_batch`
+            if not order.procurement_run_deferred:
+                procurement_obj.run(cr, uid, proc_ids, context=context)
 
             # if shipping was in exception and the user choose to recreate the
             # delivery order, write the new status of SO
@@ -103,7 +133,8 @@ class SaleOrder(models.Model):
     # OVERRIDE to use sale.order.line's procurement_group_id from lines
     ###
     @api.one
-    @api.depends('order_line.procurement_group_id.procurement_ids.state')
+    @api.depends('order_line.procurement_group_id.procurement_count',
+                 'order_line.procurement_group_id.open_procurement_count')
     def _get_shipped(self):
         """ As procurement is per sale line basis, we check each line
 
@@ -111,7 +142,8 @@ class SaleOrder(models.Model):
             isn't shipped yet.
 
             Only when all procurement are done or cancelled, we consider
-            the sale order as being shipped.
+            the sale order as being shipped. The procurement groups count
+            their open procurements, so they do not need to be read.
 
             And if there is no line, we have nothing to ship, thus it isn't
             shipped.
@@ -127,30 +159,108 @@ class SaleOrder(models.Model):
                       if line.product_id.type != 'service'])
         is_shipped = True
         for group in groups:
-            if not group or not group.procurement_ids:
+            if not group:
+                is_shipped = False
+                break
+            total, open_count = group._get_procurement_counts()
+            if not total or open_count:
                 is_shipped = False
                 break
-            is_shipped &= all([proc.state in ['cancel', 'done']
-                               for proc in group.procurement_ids])
         self.shipped = is_shipped
 
     ###
     # OVERRIDE to find sale.order.line's picking
     ###
     def _get_picking_ids(self, cr, uid, ids, name, args, context=None):
-        res = {}
-        for sale in self.browse(cr, uid, ids, context=context):
-            group_ids = set([line.procurement_group_id.id
-                             for line in sale.order_line
-                             if line.procurement_group_id])
-            if not any(group_ids):
-                res[sale.id] = []
-                continue
-            res[sale.id] = self.pool['stock.picking'].search(
-                cr, uid, [('group_id', 'in', list(group_ids))],
-                context=context)
+        """Find the pickings of all the orders at once
+
+        The pickings are joined to the orders through the procurement groups
+        of their lines, or read from the stored relation when it is enabled,
+        then filtered by a single search to apply the access rules.
+        """
+        res = dict((sale_id, []) for sale_id in ids)
+        if not ids:
+            return res
+        if self._is_picking_rel_enabled(cr, uid, context=context):
+            cr.execute("SELECT sale_order_id, picking_id"
+                       " FROM sale_order_picking_rel"
+                       " WHERE sale_order_id IN %s", (tuple(ids),))
+        else:
+            cr.execute("SELECT DISTINCT l.order_id, p.id"
+                       " FROM sale_order_line l"
+                       " JOIN stock_picking p"
+                       "  ON p.group_id = l.procurement_group_id"
+                       " WHERE l.order_id IN %s", (tuple(ids),))
+        sale_ids_by_picking = {}
+        for sale_id, picking_id in cr.fetchall():
+            sale_ids_by_picking.setdefault(picking_id, []).append(sale_id)
+        if not sale_ids_by_picking:
+            return res
+        picking_ids = self.pool['stock.picking'].search(
+            cr, uid, [('id', 'in', sale_ids_by_picking.keys())],
+            context=context)
+        for picking_id in picking_ids:
+            for sale_id in sale_ids_by_picking[picking_id]:
+                res[sale_id].append(picking_id)
         return res
 
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _is_picking_rel_enabled(self):
+        """Return whether the pickings of the orders are stored
+
+        The parameter is kept in the cache of the registry, cleared when it
+        is modified, as it is read by every write on the pickings.
+        """
+        enabled = self.env['ir.config_parameter'].get_param(
+            STORE_PICKING_IDS_PARAM)
+        return tools.str2bool(enabled, default=False)
+
+    @api.model
+    def _sync_picking_rel(self, order_ids):
+        """Update the stored pickings of orders from their lines' groups"""
+        order_ids = tuple(set(order_ids) - set([False, None]))
+        if not order_ids or not self._is_picking_rel_enabled():
+            return
+        cr = self.env.cr
+        cr.execute("DELETE FROM sale_order_picking_rel"
+                   " WHERE sale_order_id IN %s", (order_ids,))
+        cr.execute("INSERT INTO sale_order_picking_rel"
+                   " (sale_order_id, picking_id)"
+                   " SELECT DISTINCT l.order_id, p.id"
+                   " FROM sale_order_line l"
+                   " JOIN stock_picking p"
+                   "  ON p.group_id = l.procurement_group_id"
+                   " WHERE l.order_id IN %s", (order_ids,))
+        self.invalidate_cache(['picking_ids', 'stored_picking_ids'],
+                              list(order_ids))
+
+    @api.model
+    def _sync_picking_rel_by_group(self, group_ids):
+        """Update the stored pickings of the orders using procurement groups
+        """
+        group_ids = tuple(set(group_ids) - set([False, None]))
+        if not group_ids or not self._is_picking_rel_enabled():
+            return
+        self.env.cr.execute("SELECT DISTINCT order_id FROM sale_order_line"
+                            " WHERE procurement_group_id IN %s",
+                            (group_ids,))
+        self._sync_picking_rel([row[0] for row in self.env.cr.fetchall()])
+
+    def init(self, cr):
+        cr.execute("SELECT value FROM ir_config_parameter WHERE key = %s",
+                   (STORE_PICKING_IDS_PARAM,))
+        row = cr.fetchone()
+        if not row or not tools.str2bool(row[0], default=False):
+            return
+        cr.execute("DELETE FROM sale_order_picking_rel")
+        cr.execute("INSERT INTO sale_order_picking_rel"
+                   " (sale_order_id, picking_id)"
+                   " SELECT DISTINCT l.order_id, p.id"
+                   " FROM sale_order_line l"
+                   " JOIN stock_picking p"
+                   "  ON p.group_id = l.procurement_group_id")
+
     _columns = {
         'picking_ids': osv.fields.function(
             _get_picking_ids, method=True, type='one2many',
@@ -158,10 +268,52 @@ class SaleOrder(models.Model):
             string='Picking associated to this sale'),
     }
 
+    stored_picking_ids = fields.Many2many(
+        'stock.picking',
+        'sale_order_picking_rel', 'sale_order_id', 'picking_id',
+        string='Stored Pickings',
+        readonly=True,
+        copy=False,
+        help="Technical field: pickings of the order maintained "
+             "incrementally when the system parameter "
+             "sale_procurement_group_by_line.store_picking_ids is set.")
     shipped = fields.Boolean(
         compute='_get_shipped',
         string='Delivered',
         store=True)
+    procurement_run_deferred = fields.Boolean(
+        string='Procurement Run Deferred',
+        copy=False,
+        help="Technical field set while the order is confirmed in a batch: "
+             "its procurements are run with the ones of the other orders.")
+
+    @api.multi
+    def action_confirm_batch(self):
+        """Confirm many sale orders and run all their procurements at once
+
+        The orders are confirmed one by one with `action_button_confirm`,
+        so its overrides apply, but the run of their procurements is
+        deferred and done in a single call for the whole batch. The
+        procurements are sorted by warehouse, destination partner and
+        location, so the moves of the same warehouse and partner are
+        confirmed and assigned to their pickings together.
+
+        """
+        self.write({'procurement_run_deferred': True})
+        for order in self:
+            order.action_button_confirm()
+        self.write({'procurement_run_deferred': False})
+
+        procurements = self.env['procurement.order'].search(
+            [('sale_line_id.order_id', 'in', self.ids),
+             ('state', 'in', ('confirmed', 'exception'))])
+        procurements = procurements.sorted(
+            key=lambda proc: (proc.warehouse_id.id,
+                              proc.partner_dest_id.id,
+                              proc.location_id.id,
+                              proc.id))
+        procurements.run()
+        return True
 
 
 class SaleOrderLine(orm.Model):
@@ -178,4 +330,13 @@ class SaleOrderLine(orm.Model):
     procurement_group_id = fields.Many2one(
         'procurement.group',
         'Procurement group',
-        copy=False)
+        copy=False,
+        index=True)
+
+    @api.multi
+    def write(self, vals):
+        res = super(SaleOrderLine, self).write(vals)
+        if 'procurement_group_id' in vals:
+            self.env['sale.order']._sync_picking_rel(
+                self.mapped('order_id').ids)
+        return res
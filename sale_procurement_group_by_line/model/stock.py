@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#
+#
+#    Copyright 2016 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+from openerp import models, api
+
+
+class StockPicking(models.Model):
+    _inherit = 'stock.picking'
+
+    @api.model
+    def create(self, vals):
+        picking = super(StockPicking, self).create(vals)
+        if picking.group_id:
+            self.env['sale.order']._sync_picking_rel_by_group(
+                picking.group_id.ids)
+        return picking
+
+    @api.multi
+    def write(self, vals):
+        if 'group_id' not in vals:
+            return super(StockPicking, self).write(vals)
+        group_ids = self.mapped('group_id').ids
+        res = super(StockPicking, self).write(vals)
+        self.env['sale.order']._sync_picking_rel_by_group(
+            group_ids + self.mapped('group_id').ids)
+        return res
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+#
+#    Copyright 2016 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+from mock import patch
+
+from openerp.tests.common import TransactionCase
+
+
+class TestActionConfirmBatch(TransactionCase):
+
+    def setUp(self):
+        super(TestActionConfirmBatch, self).setUp()
+        partner = self.env.ref('base.res_partner_2')
+        product = self.env.ref('product.product_product_7')
+        self.orders = self.env['sale.order'].browse()
+        for __ in range(2):
+            self.orders |= self.env['sale.order'].create({
+                'partner_id': partner.id,
+                'order_policy': 'manual',
+                'order_line': [(0, 0, {'product_id': product.id,
+                                       'name': product.name,
+                                       'product_uom_qty': 1})],
+            })
+
+    def test_confirm_batch_runs_overrides(self):
+        """The overrides of action_button_confirm apply to each order"""
+        SaleOrder = type(self.env['sale.order'])
+        original = SaleOrder.action_button_confirm
+        confirmed = []
+
+        def action_button_confirm(order):
+            # the procurements are not run while the order is confirmed
+            self.assertTrue(order.procurement_run_deferred)
+            confirmed.append(order.id)
+            return original(order)
+
+        with patch.object(SaleOrder, 'action_button_confirm',
+                          action_button_confirm):
+            self.orders.action_confirm_batch()
+
+        self.assertEqual(confirmed, self.orders.ids)
+        for order in self.orders:
+            self.assertFalse(order.procurement_run_deferred)
+            self.assertEqual(order.state, 'manual')
+            procurements = order.mapped('order_line.procurement_ids')
+            self.assertTrue(procurements)
+            self.assertNotIn('confirmed', procurements.mapped('state'))
@@ -23,7 +23,7 @@
 
 {
     'name': 'Rental',
-    'version': '8.0.0.1.0',
+    'version': '8.0.0.2.0',
     'category': 'Sales Management',
     'license': 'AGPL-3',
     'summary': 'Manage Rental of Products',
@@ -20,11 +20,12 @@
 #
 ##############################################################################
 
-from openerp import models, fields, api, _
+from openerp import models, fields, api, tools, _
 from openerp.exceptions import Warning, ValidationError
 from openerp.tools import float_compare
 from dateutil.relativedelta import relativedelta
 import openerp.addons.decimal_precision as dp
+from .rental_availability import RentalAvailability
 import logging
 
 logger = logging.getLogger(__name__)
@@ -77,6 +78,8 @@ class SaleOrder(models.Model):
             self, order, line, group_id=False):
         res = super(SaleOrder, self)._prepare_order_line_procurement(
             order, line, group_id=group_id)
+        rental_config = self.env['stock.warehouse']._get_rental_config(
+            order.warehouse_id.id)
         if (
                 line.product_id.rented_product_id and
                 line.rental_type == 'new_rental'):
@@ -86,15 +89,13 @@ class SaleOrder(models.Model):
                 'product_uos_qty': line.rental_qty,
                 'product_uom': line.product_id.rented_product_id.uom_id.id,
                 'product_uos': line.product_id.rented_product_id.uom_id.id,
-                'location_id':
-                order.warehouse_id.rental_out_location_id.id,
-                'route_ids':
-                [(6, 0, [line.order_id.warehouse_id.rental_route_id.id])],
+                'location_id': rental_config['rental_out_location_id'],
+                'route_ids': [(6, 0, [rental_config['rental_route_id']])],
                 'date_planned': self._get_rental_date_planned(line),
                 })
         elif line.sell_rental_id:
             res['route_ids'] = [(6, 0, [
-                line.order_id.warehouse_id.sell_rented_product_route_id.id])]
+                rental_config['sell_rented_product_route_id']])]
         return res
 
     @api.model
@@ -104,21 +105,35 @@ class SaleOrder(models.Model):
     @api.multi
     def action_button_confirm(self):
         res = super(SaleOrder, self).action_button_confirm()
+        rental_vals = []
+        in_move_ids_by_date = {}
+        sold_in_moves = self.env['stock.move'].browse()
         for order in self:
             for line in order.order_line:
                 if line.rental_type == 'new_rental':
-                    self.env['sale.rental'].create(self._prepare_rental(line))
+                    rental_vals.append(self._prepare_rental(line))
                 elif line.rental_type == 'rental_extension':
-                    line.extension_rental_id.in_move_id.date_expected =\
-                        line.end_date
-                    line.extension_rental_id.in_move_id.date = line.end_date
+                    in_move = line.extension_rental_id.in_move_id
+                    in_move_ids_by_date.setdefault(
+                        line.end_date, []).append(in_move.id)
                 elif line.sell_rental_id:
                     if line.sell_rental_id.out_move_id.state != 'done':
                         raise Warning(
                             _('Cannot sell the rental %s because it has '
                                 'not been delivered')
                             % line.sell_rental_id.display_name)
-                    line.sell_rental_id.in_move_id.action_cancel()
+                    sold_in_moves |= line.sell_rental_id.in_move_id
+        if rental_vals:
+            # the stored fields of the rentals are computed all at once
+            rental_obj = self.env['sale.rental'].with_context(recompute=False)
+            for vals in rental_vals:
+                rental_obj.create(vals)
+            self.env['sale.rental'].recompute()
+        for end_date, move_ids in in_move_ids_by_date.iteritems():
+            self.env['stock.move'].browse(move_ids).write(
+                {'date_expected': end_date, 'date': end_date})
+        if sold_in_moves:
+            sold_in_moves.action_cancel()
         return res
 
 
@@ -140,6 +155,72 @@ class SaleOrderLine(models.Model):
     sell_rental_id = fields.Many2one(
         'sale.rental', string='Rental to Sell')
 
+    @api.multi
+    def _get_rental_free_qty(self):
+        """Quantity of the rented product free during the line's period"""
+        self.ensure_one()
+        return self._get_rental_free_qties()[self]
+
+    @api.multi
+    def _get_rental_free_qties(self):
+        """Quantities of the rented products free during the lines' periods
+
+        The rentals created by the lines of their orders, or extended by
+        the lines, are not counted as booked. The rental lines of these
+        orders are counted as booked instead, their rentals not being
+        created before the orders are confirmed.
+
+        The lines are grouped by warehouse, and by rental extended, so the
+        bookings and the capacity of all the products of a group are read
+        at once.
+
+        :return: dict of the free quantity by line, False when the line has
+                 no warehouse, rented product or dates
+        """
+        res = dict((line, False) for line in self)
+        groups = {}
+        for line in self:
+            if not (line.order_id.warehouse_id and
+                    line.product_id.rented_product_id and
+                    line.start_date and line.end_date):
+                continue
+            extended_rental = self.env['sale.rental'].browse()
+            if line.rental_type == 'rental_extension':
+                extended_rental = line.extension_rental_id
+            key = (line.order_id.warehouse_id, extended_rental)
+            groups[key] = groups.get(key, self.browse()) | line
+        for (warehouse, extended_rental), lines in groups.iteritems():
+            products = lines.mapped('product_id.rented_product_id')
+            booking_lines = (lines.mapped('order_id.order_line') | lines)
+            booking_lines = booking_lines.filtered(
+                lambda line: line.state != 'cancel' and
+                line.rental_type in ('new_rental', 'rental_extension') and
+                line.product_id.rented_product_id in products)
+            line_ids = [line_id for line_id in booking_lines.ids
+                        if isinstance(line_id, (int, long))]
+            exclude_rentals = extended_rental
+            if line_ids:
+                exclude_rentals |= exclude_rentals.search(
+                    [('start_order_line_id', 'in', line_ids)])
+            extra_bookings = {}
+            for line in booking_lines:
+                extra_bookings.setdefault(
+                    line.product_id.rented_product_id.id, []).append(
+                    (line.start_date, line.end_date, line.rental_qty))
+            availability = self.env['sale.rental']._get_rental_availability(
+                products.ids, warehouse,
+                exclude_rental_ids=exclude_rentals.ids,
+                extra_bookings=extra_bookings)
+            capacities = warehouse._get_rental_capacities(products)
+            for line in lines:
+                product_id = line.product_id.rented_product_id.id
+                res[line] = availability[product_id].free_qty(
+                    line.start_date, line.end_date, capacities[product_id])
+                if line in booking_lines:
+                    # the line itself is booked over its whole period
+                    res[line] += line.rental_qty
+        return res
+
     @api.one
     @api.constrains(
         'rental_type', 'extension_rental_id', 'start_date', 'end_date',
@@ -193,6 +274,34 @@ class SaleOrderLine(models.Model):
                         self.product_uom_qty,
                         self.sell_rental_id.rental_qty))
 
+    @api.multi
+    def _check_rental_overbooking(self):
+        """Block the rental lines renting more units than are free"""
+        lines = self.filtered(
+            lambda line: line.rental_type in ('new_rental',
+                                              'rental_extension') and
+            line.order_id.warehouse_id.rental_prevent_overbooking)
+        free_qties = lines._get_rental_free_qties()
+        for line in lines:
+            free_qty = free_qties[line]
+            rounding = line.product_id.rented_product_id.uom_id.rounding
+            if free_qty is not False and float_compare(
+                    free_qty, line.rental_qty,
+                    precision_rounding=rounding) < 0:
+                raise ValidationError(
+                    _("On the sale order line with product '%s', "
+                        "you want to rent %s units from %s to %s but "
+                        "only %s are available over this period.") % (
+                        line.product_id.name, line.rental_qty,
+                        line.start_date, line.end_date, free_qty))
+
+    @api.multi
+    def button_confirm(self):
+        # the availability is checked once, when the lines are confirmed
+        self.filtered(
+            lambda line: line.state == 'draft')._check_rental_overbooking()
+        return super(SaleOrderLine, self).button_confirm()
+
     @api.multi
     def need_procurement(self):
         res = super(SaleOrderLine, self).need_procurement()
@@ -302,6 +411,25 @@ class SaleOrderLine(models.Model):
             self.start_date = initial_end_date + relativedelta(days=1)
             self.rental_qty = self.extension_rental_id.rental_qty
 
+    @api.onchange('start_date', 'end_date', 'rental_qty')
+    def rental_availability_change(self):
+        if (
+                self.rental_type in ('new_rental', 'rental_extension') and
+                self.rental_qty):
+            free_qty = self._get_rental_free_qty()
+            product_uom = self.product_id.rented_product_id.uom_id
+            if free_qty is not False and float_compare(
+                    free_qty, self.rental_qty,
+                    precision_rounding=product_uom.rounding) < 0:
+                return {'warning': {
+                    'title': _("Not enough stock !"),
+                    'message':
+                    _("You want to rent %.2f %s from %s to %s but only "
+                        "%.2f %s are available over this period.")
+                    % (self.rental_qty, product_uom.name, self.start_date,
+                        self.end_date, max(free_qty, 0), product_uom.name),
+                    }}
+
     @api.onchange('sell_rental_id')
     def sell_rental_id_change(self):
         if self.sell_rental_id:
@@ -340,7 +468,9 @@ class SaleRental(models.Model):
             self.state)  # TODO : display label, not the technical key
 
     @api.one
-    @api.depends('start_order_line_id', 'start_order_line_id.procurement_ids')
+    @api.depends(
+        'start_order_line_id', 'start_order_line_id.procurement_ids',
+        'sell_order_line_ids', 'sell_order_line_ids.procurement_ids')
     def _compute_procurement_and_move(self):
         procurement = False
         in_move = False
@@ -386,20 +516,97 @@ class SaleRental(models.Model):
         self.sell_procurement_id = sell_procurement
         self.sell_move_id = sell_move
 
-    @api.one
+    @api.multi
     @api.depends(
         'extension_order_line_ids.end_date', 'extension_order_line_ids.state',
         'start_order_line_id.end_date')
     def _compute_end_date(self):
-        end_date = False
-        if self.extension_order_line_ids:
-            for extension in self.extension_order_line_ids:
-                if extension.state not in ('cancel', 'draft'):
-                    if extension.end_date > end_date:
-                        end_date = extension.end_date
-        if not end_date and self.start_order_line_id:
-            end_date = self.start_order_line_id.end_date
-        self.end_date = end_date
+        rental_ids = [rental_id for rental_id in self.ids
+                      if isinstance(rental_id, (int, long))]
+        extension_end_dates = {}
+        if rental_ids:
+            self.env.cr.execute(
+                "SELECT extension_rental_id, max(end_date)"
+                " FROM sale_order_line"
+                " WHERE extension_rental_id IN %s"
+                " AND state NOT IN ('draft', 'cancel')"
+                " GROUP BY extension_rental_id", (tuple(rental_ids),))
+            extension_end_dates = dict(self.env.cr.fetchall())
+        for rental in self:
+            if isinstance(rental.id, (int, long)):
+                end_date = extension_end_dates.get(rental.id, False)
+            else:
+                end_date = False
+                for extension in rental.extension_order_line_ids:
+                    if extension.state not in ('cancel', 'draft'):
+                        if extension.end_date > end_date:
+                            end_date = extension.end_date
+            if not end_date and rental.start_order_line_id:
+                end_date = rental.start_order_line_id.end_date
+            rental.end_date = end_date
+
+    @api.model
+    def _get_rentals_from_moves(self, move_ids):
+        """Return the rentals whose procurements generated the moves"""
+        if not move_ids:
+            return self.browse()
+        self.env.cr.execute(
+            "SELECT r.id FROM sale_rental r"
+            " JOIN procurement_order p"
+            "  ON p.sale_line_id = r.start_order_line_id"
+            " JOIN stock_move m ON m.procurement_id = p.id"
+            " WHERE m.id IN %s"
+            " UNION"
+            " SELECT l.sell_rental_id FROM sale_order_line l"
+            " JOIN procurement_order p ON p.sale_line_id = l.id"
+            " JOIN stock_move m ON m.procurement_id = p.id"
+            " WHERE m.id IN %s AND l.sell_rental_id IS NOT NULL",
+            (tuple(move_ids), tuple(move_ids)))
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    @api.multi
+    def _update_procurement_and_move(self):
+        """Recompute the stored moves and state of the rentals"""
+        if not self:
+            return
+        for fname in ('procurement_id', 'in_move_id', 'out_move_id',
+                      'sell_procurement_id', 'sell_move_id', 'state'):
+            self.env.add_todo(self._fields[fname], self)
+        self.recompute()
+
+    @api.model
+    def _get_rental_availability(self, product_ids, warehouse,
+                                 exclude_rental_ids=None,
+                                 extra_bookings=None):
+        """Return the bookings of the rented products in the warehouse
+
+        The rentals which are ordered or out are read with one query.
+
+        :param extra_bookings: dict of lists of (start date, end date, qty)
+                               by rented product id, booked in addition to
+                               the rentals
+        :return: dict of rented product id: RentalAvailability
+        """
+        bookings = dict((product_id, list((extra_bookings or {}).get(
+            product_id, []))) for product_id in product_ids)
+        if not product_ids:
+            return {}
+        self.env.cr.execute(
+            "SELECT p.rented_product_id, l.start_date, r.end_date,"
+            " l.rental_qty"
+            " FROM sale_rental r"
+            " JOIN sale_order_line l ON l.id = r.start_order_line_id"
+            " JOIN sale_order o ON o.id = l.order_id"
+            " JOIN product_product p ON p.id = l.product_id"
+            " WHERE p.rented_product_id IN %s AND o.warehouse_id = %s"
+            " AND r.state IN ('ordered', 'out', 'sell_progress')"
+            " AND r.id NOT IN %s",
+            (tuple(product_ids), warehouse.id,
+             tuple(exclude_rental_ids or [0])))
+        for product_id, start_date, end_date, qty in self.env.cr.fetchall():
+            bookings[product_id].append((start_date, end_date, qty))
+        return dict((product_id, RentalAvailability(product_bookings))
+                    for product_id, product_bookings in bookings.iteritems())
 
     display_name = fields.Char(
         compute='_display_name', string='Display Name')
@@ -429,13 +636,13 @@ class SaleRental(models.Model):
         string='Partner', readonly=True)
     procurement_id = fields.Many2one(
         'procurement.order', string="Procurement", readonly=True,
-        compute='_compute_procurement_and_move')
+        compute='_compute_procurement_and_move', store=True)
     out_move_id = fields.Many2one(
         'stock.move', compute='_compute_procurement_and_move',
-        string='Outgoing Stock Move', readonly=True)
+        string='Outgoing Stock Move', readonly=True, store=True)
     in_move_id = fields.Many2one(
         'stock.move', compute='_compute_procurement_and_move',
-        string='Return Stock Move', readonly=True)
+        string='Return Stock Move', readonly=True, store=True)
     out_state = fields.Selection([
         ('draft', 'New'),
         ('cancel', 'Cancelled'),
@@ -468,10 +675,10 @@ class SaleRental(models.Model):
         string='Sell Rented Product', readonly=True)
     sell_procurement_id = fields.Many2one(
         'procurement.order', string="Sell Procurement", readonly=True,
-        compute='_compute_procurement_and_move')
+        compute='_compute_procurement_and_move', store=True)
     sell_move_id = fields.Many2one(
         'stock.move', compute='_compute_procurement_and_move',
-        string='Sell Stock Move', readonly=True)
+        string='Sell Stock Move', readonly=True, store=True)
     sell_state = fields.Selection([
         ('draft', 'New'),
         ('cancel', 'Cancelled'),
@@ -486,7 +693,7 @@ class SaleRental(models.Model):
         string='Sell Delivery Order', readonly=True)
     end_date = fields.Date(
         compute='_compute_end_date', string='End Date (extensions included)',
-        readonly=True,
+        readonly=True, store=True, index=True,
         help="End Date of the Rental, taking into account all the "
         "extensions sold to the customer.")
     state = fields.Selection([
@@ -496,7 +703,7 @@ class SaleRental(models.Model):
         ('sold', 'Sold'),
         ('in', 'Back In'),
         ], string='State', compute='_compute_procurement_and_move',
-        readonly=True)
+        readonly=True, store=True, index=True)
 
 
 class StockWarehouse(models.Model):
@@ -507,15 +714,55 @@ class StockWarehouse(models.Model):
     rental_out_location_id = fields.Many2one(
         'stock.location', 'Rental Out', domain=[('usage', '<>', 'view')])
     rental_allowed = fields.Boolean('Rental Allowed', default=True)
+    rental_prevent_overbooking = fields.Boolean(
+        'Prevent Rental Over-booking',
+        help="Block the confirmation of rentals when the rented products "
+        "are already booked by other rentals over the same period.")
     rental_route_id = fields.Many2one(
         'stock.location.route', string='Rental Route')
     sell_rented_product_route_id = fields.Many2one(
         'stock.location.route', string='Sell Rented Product Route')
 
     @api.multi
-    def _get_rental_push_pull_rules(self):
+    def _get_rental_capacities(self, products):
+        """Quantities of the products in the rental stock locations
+
+        :return: dict of quantity by product id
+        """
         self.ensure_one()
-        route_obj = self.env['stock.location.route']
+        products = products.with_context(location=[
+            self.rental_in_location_id.id,
+            self.rental_out_location_id.id])
+        return dict((data['id'], data['qty_available'])
+                    for data in products.read(['qty_available']))
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_rental_config(self, warehouse_id):
+        """Return the rental configuration of a warehouse
+
+        The ids of the rental routes and locations are kept in the cache
+        of the registry until a warehouse or a route is modified.
+
+        """
+        warehouse = self.browse(warehouse_id)
+        return {
+            'rental_allowed': warehouse.rental_allowed,
+            'rental_route_id': warehouse.rental_route_id.id,
+            'sell_rented_product_route_id':
+            warehouse.sell_rented_product_route_id.id,
+            'rental_in_location_id': warehouse.rental_in_location_id.id,
+            'rental_out_location_id': warehouse.rental_out_location_id.id,
+            }
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_rental_generic_route_ids(self, lang):
+        """Return the ids of the generic 'Rent' and 'Sell Rented Product'
+        routes, searched by name when their XML ids have been removed
+
+        """
+        route_obj = self.env['stock.location.route'].with_context(lang=lang)
         try:
             rental_route = self.env.ref('sale_rental.route_warehouse0_rental')
         except:
@@ -535,6 +782,13 @@ class StockWarehouse(models.Model):
         if not sell_rented_product_route:
             raise Warning(
                 _("Can't find any generic 'Sell Rented Product' route."))
+        return rental_route.id, sell_rented_product_route.id
+
+    @api.multi
+    def _get_rental_push_pull_rules(self):
+        self.ensure_one()
+        rental_route_id, sell_rented_product_route_id =\
+            self._get_rental_generic_route_ids(self.env.context.get('lang'))
 
         if not self.rental_in_location_id:
             raise Warning(
@@ -550,7 +804,7 @@ class StockWarehouse(models.Model):
                 self.rental_out_location_id, self.env.context),
             'location_id': self.rental_out_location_id.id,
             'location_src_id': self.rental_in_location_id.id,
-            'route_id': rental_route.id,
+            'route_id': rental_route_id,
             'action': 'move',
             'picking_type_id': self.out_type_id.id,
             'warehouse_id': self.id,
@@ -561,7 +815,7 @@ class StockWarehouse(models.Model):
                 self.rental_in_location_id, self.env.context),
             'location_from_id': self.rental_out_location_id.id,
             'location_dest_id': self.rental_in_location_id.id,
-            'route_id': rental_route.id,
+            'route_id': rental_route_id,
             'auto': 'auto',
             'invoice_state': 'none',
             'picking_type_id': self.in_type_id.id,
@@ -573,7 +827,7 @@ class StockWarehouse(models.Model):
                 self.out_type_id.default_location_dest_id, self.env.context),
             'location_id': self.out_type_id.default_location_dest_id.id,
             'location_src_id': self.rental_out_location_id.id,
-            'route_id': sell_rented_product_route.id,
+            'route_id': sell_rented_product_route_id,
             'action': 'move',
             'picking_type_id': self.out_type_id.id,
             'warehouse_id': self.id,
@@ -585,27 +839,85 @@ class StockWarehouse(models.Model):
             'stock.location.path': [rental_push_rule],
             }
 
+    @api.multi
+    def _create_rental_push_pull_rules(self):
+        """Create the rental rules of all the warehouses
+
+        The rules of all the warehouses are prepared first, then created
+        model by model.
+        """
+        rules_by_model = {}
+        for warehouse in self:
+            for obj, rules_list in\
+                    warehouse._get_rental_push_pull_rules().iteritems():
+                rules_by_model.setdefault(obj, []).extend(rules_list)
+        for obj, rules_list in rules_by_model.iteritems():
+            rule_obj = self.env[obj]
+            for rule in rules_list:
+                rule_obj.create(rule)
+
+    @api.multi
+    def _unlink_rental_push_pull_rules(self):
+        routes = (self.mapped('rental_route_id') |
+                  self.mapped('sell_rented_product_route_id'))
+        routes.mapped('pull_ids').unlink()
+        routes.mapped('push_ids').unlink()
+
     @api.multi
     def write(self, vals):
         if 'rental_allowed' in vals:
             if vals.get('rental_allowed'):
-                for warehouse in self:
-                    for obj, rules_list in\
-                            self._get_rental_push_pull_rules().iteritems():
-                        for rule in rules_list:
-                            self.env[obj].create(rule)
+                self._create_rental_push_pull_rules()
             else:
-                for warehouse in self:
-                    warehouse.rental_route_id.pull_ids.unlink()
-                    warehouse.rental_route_id.push_ids.unlink()
-                    warehouse.sell_rented_product_route_id.pull_ids.unlink()
-                    warehouse.sell_rented_product_route_id.push_ids.unlink()
-        return super(StockWarehouse, self).write(vals)
+                self._unlink_rental_push_pull_rules()
+        res = super(StockWarehouse, self).write(vals)
+        self.clear_caches()
+        return res
+
+
+class StockLocationRoute(models.Model):
+    _inherit = 'stock.location.route'
+
+    @api.model
+    def create(self, vals):
+        route = super(StockLocationRoute, self).create(vals)
+        self.env['stock.warehouse'].clear_caches()
+        return route
+
+    @api.multi
+    def write(self, vals):
+        res = super(StockLocationRoute, self).write(vals)
+        self.env['stock.warehouse'].clear_caches()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super(StockLocationRoute, self).unlink()
+        self.env['stock.warehouse'].clear_caches()
+        return res
 
 
 class StockMove(models.Model):
     _inherit = 'stock.move'
 
+    @api.model
+    def create(self, vals):
+        move = super(StockMove, self).create(vals)
+        if vals.get('procurement_id'):
+            self.env['sale.rental']._get_rentals_from_moves(
+                move.ids)._update_procurement_and_move()
+        return move
+
+    @api.multi
+    def write(self, vals):
+        res = super(StockMove, self).write(vals)
+        if (
+                'state' in vals or 'move_dest_id' in vals or
+                'procurement_id' in vals):
+            self.env['sale.rental']._get_rentals_from_moves(
+                self.ids)._update_procurement_and_move()
+        return res
+
     @api.model
     def _create_invoice_line_from_vals(self, move, invoice_line_vals):
         '''When we invoice from delivery, we shouldn't invoice
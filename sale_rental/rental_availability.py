@@ -0,0 +1,106 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    Sale Rental module for Odoo
+#    Copyright (C) 2014-2015 Akretion (http://www.akretion.com)
+#    @author Alexis de Lattre <alexis.delattre@akretion.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def next_day(date):
+    return (datetime.strptime(date, DATE_FORMAT) +
+            timedelta(days=1)).strftime(DATE_FORMAT)
+
+
+class RentalAvailability(object):
+    """Booked quantities of a rented product over time
+
+    Built from the (start date, end date, quantity) of the rentals, the
+    dates being strings in the server format and both bounds included.
+    The bookings are turned into the sorted dates where the booked
+    quantity changes, with the booked quantity from each of these dates
+    and a sparse table of their maximums, so that the booked quantity at a
+    date, the maximum booked quantity over a period and the number of
+    rentals overlapping a period are answered by binary searches.
+    """
+
+    def __init__(self, bookings):
+        changes = {}
+        self.starts = []
+        self.ends = []
+        for start_date, end_date, qty in bookings:
+            if not start_date or not end_date or end_date < start_date:
+                continue
+            self.starts.append(start_date)
+            self.ends.append(end_date)
+            changes[start_date] = changes.get(start_date, 0.0) + qty
+            stop_date = next_day(end_date)
+            changes[stop_date] = changes.get(stop_date, 0.0) - qty
+        self.starts.sort()
+        self.ends.sort()
+        self.dates = sorted(changes)
+        self.booked = []
+        booked = 0.0
+        for date in self.dates:
+            booked += changes[date]
+            self.booked.append(booked)
+        # maximums[k][i] is the max booked quantity of dates[i:i + 2 ** k]
+        self.maximums = [self.booked]
+        width = 1
+        while width * 2 <= len(self.booked):
+            previous = self.maximums[-1]
+            self.maximums.append([
+                max(previous[i], previous[i + width])
+                for i in xrange(len(previous) - width)])
+            width *= 2
+
+    def _max_between(self, first, last):
+        """Max booked quantity from dates[first] to dates[last] included"""
+        level = (last - first + 1).bit_length() - 1
+        return max(self.maximums[level][first],
+                   self.maximums[level][last - (1 << level) + 1])
+
+    def booked_qty_at(self, date):
+        """Quantity booked on the date"""
+        index = bisect_right(self.dates, date) - 1
+        if index < 0:
+            return 0.0
+        return self.booked[index]
+
+    def max_booked_qty(self, start_date, end_date):
+        """Maximum quantity booked on a day of the period"""
+        first = bisect_right(self.dates, start_date) - 1
+        last = bisect_right(self.dates, end_date) - 1
+        if last < 0:
+            return 0.0
+        # nothing is booked before the first date
+        return self._max_between(max(first, 0), last)
+
+    def free_qty(self, start_date, end_date, capacity):
+        """Quantity that can be rented on every day of the period"""
+        return capacity - self.max_booked_qty(start_date, end_date)
+
+    def count_overlapping(self, start_date, end_date):
+        """Number of bookings overlapping the period"""
+        started = bisect_right(self.starts, end_date)
+        ended = bisect_left(self.ends, start_date)
+        return started - ended
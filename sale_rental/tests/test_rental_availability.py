@@ -0,0 +1,108 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    Sale Rental module for Odoo
+#    Copyright (C) 2014-2015 Akretion (http://www.akretion.com)
+#    @author Alexis de Lattre <alexis.delattre@akretion.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from openerp.tests import common
+
+from ..rental_availability import RentalAvailability
+
+
+class TestRentalAvailability(common.BaseCase):
+
+    def setUp(self):
+        super(TestRentalAvailability, self).setUp()
+        self.availability = RentalAvailability([
+            ('2016-03-01', '2016-03-10', 2.0),
+            ('2016-03-05', '2016-03-15', 3.0),
+            ('2016-03-20', '2016-03-20', 1.0),
+            # invalid or incomplete bookings are ignored
+            ('2016-04-10', '2016-04-01', 5.0),
+            ('2016-04-10', False, 5.0),
+        ])
+
+    def test_booked_qty_at(self):
+        self.assertEqual(self.availability.booked_qty_at('2016-02-28'), 0)
+        self.assertEqual(self.availability.booked_qty_at('2016-03-01'), 2)
+        self.assertEqual(self.availability.booked_qty_at('2016-03-05'), 5)
+        # both bounds of a booking are included
+        self.assertEqual(self.availability.booked_qty_at('2016-03-10'), 5)
+        self.assertEqual(self.availability.booked_qty_at('2016-03-11'), 3)
+        self.assertEqual(self.availability.booked_qty_at('2016-03-16'), 0)
+        self.assertEqual(self.availability.booked_qty_at('2016-03-20'), 1)
+        self.assertEqual(self.availability.booked_qty_at('2016-04-05'), 0)
+
+    def test_max_booked_qty(self):
+        self.assertEqual(
+            self.availability.max_booked_qty('2016-02-01', '2016-02-28'), 0)
+        self.assertEqual(
+            self.availability.max_booked_qty('2016-02-01', '2016-03-04'), 2)
+        self.assertEqual(
+            self.availability.max_booked_qty('2016-03-02', '2016-03-30'), 5)
+        self.assertEqual(
+            self.availability.max_booked_qty('2016-03-11', '2016-03-19'), 3)
+        self.assertEqual(
+            self.availability.max_booked_qty('2016-03-16', '2016-03-19'), 0)
+        self.assertEqual(
+            self.availability.max_booked_qty('2016-03-18', '2016-03-25'), 1)
+        self.assertEqual(
+            self.availability.max_booked_qty('2016-03-21', '2016-05-01'), 0)
+
+    def test_free_qty(self):
+        self.assertEqual(
+            self.availability.free_qty('2016-03-01', '2016-03-04', 5), 3)
+        self.assertEqual(
+            self.availability.free_qty('2016-03-01', '2016-03-31', 5), 0)
+        self.assertEqual(
+            self.availability.free_qty('2016-03-16', '2016-03-19', 5), 5)
+
+    def test_free_qty_with_own_booking(self):
+        # a line checked among the bookings gets back its own quantity
+        bookings = [('2016-03-01', '2016-03-10', 2.0),
+                    ('2016-03-05', '2016-03-15', 3.0)]
+        own = ('2016-03-08', '2016-03-12', 1.0)
+        with_own = RentalAvailability(bookings + [own])
+        self.assertEqual(
+            with_own.free_qty('2016-03-08', '2016-03-12', 8) + own[2],
+            RentalAvailability(bookings).free_qty(
+                '2016-03-08', '2016-03-12', 8))
+
+    def test_count_overlapping(self):
+        self.assertEqual(
+            self.availability.count_overlapping('2016-02-01', '2016-02-28'),
+            0)
+        self.assertEqual(
+            self.availability.count_overlapping('2016-03-10', '2016-03-10'),
+            2)
+        self.assertEqual(
+            self.availability.count_overlapping('2016-03-15', '2016-03-20'),
+            2)
+        self.assertEqual(
+            self.availability.count_overlapping('2016-03-21', '2016-04-30'),
+            0)
+
+    def test_empty(self):
+        availability = RentalAvailability([])
+        self.assertEqual(
+            availability.max_booked_qty('2016-03-01', '2016-03-31'), 0)
+        self.assertEqual(
+            availability.count_overlapping('2016-03-01', '2016-03-31'), 0)
+        self.assertEqual(
+            availability.free_qty('2016-03-01', '2016-03-31', 4), 4)
@@ -33,55 +33,125 @@ class stock_picking(orm.Model):
             We select the partner of the sales order as the partner of the
             customer invoice
         """
-        sale_line_obj = self.pool['sale.order.line']
-        line_ids = sale_line_obj.search(
-            cr, uid, [('procurement_group_id', '=', picking.group_id.id)],
-            context=context)
-        if line_ids:
-            lines = sale_line_obj.browse(cr, uid, line_ids, context=context)
-            saleorder = lines[0].order_id
-            return saleorder.partner_invoice_id.id
+        if picking.sale_id:
+            return picking.sale_id.partner_invoice_id.id
         return super(stock_picking, self)._get_partner_to_invoice(
             cr, uid, picking, context=context)
 
-    def _get_sale_id(self, cr, uid, ids, name, args, context=None):
-        sale_line_obj = self.pool['sale.order.line']
+    def _get_sale_ids_by_group(self, cr, uid, group_ids, context=None):
+        """ Return the sale order of each procurement group
+
+        The order of the first line of the group is taken, following the
+        default order of the sale order lines.
+        """
         res = {}
-        for picking in self.browse(cr, uid, ids, context=context):
-            res[picking.id] = False
-            if picking.group_id:
-                line_ids = sale_line_obj.search(
-                    cr, uid,
-                    [('procurement_group_id', '=', picking.group_id.id)],
-                    context=context)
-                if line_ids:
-                    lines = sale_line_obj.browse(cr, uid, line_ids,
-                                                 context=context)
-                    res[picking.id] = lines[0].order_id
+        if not group_ids:
+            return res
+        cr.execute("SELECT DISTINCT ON (procurement_group_id)"
+                   " procurement_group_id, order_id"
+                   " FROM sale_order_line"
+                   " WHERE procurement_group_id IN %s"
+                   " ORDER BY procurement_group_id,"
+                   "  order_id DESC, sequence, id",
+                   (tuple(group_ids),))
+        res.update(cr.fetchall())
         return res
 
+    def _get_sale_id(self, cr, uid, ids, name, args, context=None):
+        res = dict.fromkeys(ids, False)
+        if not ids:
+            return res
+        cr.execute("SELECT id, group_id FROM stock_picking"
+                   " WHERE id IN %s AND group_id IS NOT NULL",
+                   (tuple(ids),))
+        group_by_picking = dict(cr.fetchall())
+        sale_by_group = self._get_sale_ids_by_group(
+            cr, uid, list(set(group_by_picking.values())), context=context)
+        for picking_id, group_id in group_by_picking.iteritems():
+            res[picking_id] = sale_by_group.get(group_id, False)
+        return res
+
+    def _get_picking_from_sale_line(self, cr, uid, ids, context=None):
+        cr.execute("SELECT p.id FROM stock_picking p"
+                   " JOIN sale_order_line l"
+                   "  ON l.procurement_group_id = p.group_id"
+                   " WHERE l.id IN %s", (tuple(ids),))
+        return [row[0] for row in cr.fetchall()]
+
     _columns = {
         'sale_id': fields.function(
             _get_sale_id, type="many2one",
-            relation="sale.order", string="Sale Order"),
+            relation="sale.order", string="Sale Order",
+            store={
+                'stock.picking': (lambda self, cr, uid, ids, c=None: ids,
+                                  ['group_id'], 10),
+                'sale.order.line': (_get_picking_from_sale_line,
+                                    ['procurement_group_id', 'order_id'],
+                                    10),
+            }),
     }
 
     def _create_invoice_from_picking(self, cr, uid, picking, vals,
                                      context=None):
-        sale_line_obj = self.pool['sale.order.line']
-        invoice_line_obj = self.pool.get('account.invoice.line')
         invoice_id = super(stock_picking, self)._create_invoice_from_picking(
             cr, uid, picking, vals, context=context)
         if picking.group_id:
-            line_ids = sale_line_obj.search(
-                cr, uid, [('procurement_group_id', '=', picking.group_id.id),
-                          ('product_id.type', '=', 'service'),
-                          ('invoiced', '=', False)], context=context)
-
-            if line_ids:
-                created_lines = sale_line_obj.invoice_line_create(
-                    cr, uid, line_ids, context=context)
-                invoice_line_obj.write(
-                    cr, uid, created_lines, {'invoice_id': invoice_id},
+            pending = (context or {}).get('sale_service_invoice_groups')
+            if pending is not None:
+                # collected and invoiced at once by _invoice_create_line
+                pending.append((picking.group_id.id, invoice_id))
+            else:
+                self._create_service_invoice_lines(
+                    cr, uid, [(picking.group_id.id, invoice_id)],
                     context=context)
         return invoice_id
+
+    def _create_service_invoice_lines(self, cr, uid, group_invoices,
+                                      context=None):
+        """ Invoice the service lines of the procurement groups
+
+        :param group_invoices: list of (procurement group id, invoice id)
+        :return: True if invoice lines have been created
+        """
+        sale_line_obj = self.pool['sale.order.line']
+        invoice_line_obj = self.pool['account.invoice.line']
+        invoice_by_group = {}
+        for group_id, invoice_id in group_invoices:
+            # the first invoice of a group gets its service lines
+            invoice_by_group.setdefault(group_id, invoice_id)
+        line_ids = sale_line_obj.search(
+            cr, uid, [('procurement_group_id', 'in', invoice_by_group.keys()),
+                      ('product_id.type', '=', 'service'),
+                      ('invoiced', '=', False)], context=context)
+        if not line_ids:
+            return False
+        line_ids_by_invoice = {}
+        for line in sale_line_obj.browse(cr, uid, line_ids, context=context):
+            invoice_id = invoice_by_group[line.procurement_group_id.id]
+            line_ids_by_invoice.setdefault(invoice_id, []).append(line.id)
+        for invoice_id, inv_line_ids in line_ids_by_invoice.iteritems():
+            created_lines = sale_line_obj.invoice_line_create(
+                cr, uid, inv_line_ids, context=context)
+            invoice_line_obj.write(
+                cr, uid, created_lines, {'invoice_id': invoice_id},
+                context=context)
+        return True
+
+    def _invoice_create_line(self, cr, uid, moves, journal_id,
+                             inv_type='out_invoice', context=None):
+        """ Invoice the service lines of all the pickings at once
+
+        The service lines are searched with one query for the procurement
+        groups of all the invoiced pickings and created per invoice.
+        """
+        pending = []
+        ctx = dict(context or {}, sale_service_invoice_groups=pending)
+        invoice_ids = super(stock_picking, self)._invoice_create_line(
+            cr, uid, moves, journal_id, inv_type=inv_type, context=ctx)
+        if pending and self._create_service_invoice_lines(
+                cr, uid, pending, context=context):
+            invoice_ids_to_compute = list(set(inv for __, inv in pending))
+            self.pool['account.invoice'].button_compute(
+                cr, uid, invoice_ids_to_compute, context=context,
+                set_total=(inv_type in ('in_invoice', 'in_refund')))
+        return invoice_ids